@@ -3,10 +3,14 @@ source venv/bin/activate
 
 echo "Updating database"
 python manage.py migrate
+python manage.py createcachetable
 python manage.py collectstatic_js_reverse
 python manage.py collectstatic --noinput
 echo "Done"
 
 chmod -R 755 /opt/recipes/mediafiles
 
-exec gunicorn -b :8080 --access-logfile - --error-logfile - --log-level INFO recipes.wsgi
\ No newline at end of file
+# deletes old history every RETENTION_INTERVAL hours, exits at once when it is not set
+python manage.py cleanuphistory --schedule &
+
+exec gunicorn -b :8080 --threads ${GUNICORN_THREADS:-4} --access-logfile - --error-logfile - --log-level INFO recipes.wsgi
\ No newline at end of file
@@ -8,7 +8,7 @@ from django_scopes import scopes_disabled
 from treebeard.admin import TreeAdmin
 from treebeard.forms import movenodeform_factory
 
-from cookbook.managers import DICTIONARY
+from cookbook.managers import DICTIONARY, update_search_document
 
 from .models import (BookmarkletImport, Comment, CookLog, Food, FoodInheritField, ImportLog,
                      Ingredient, InviteLink, Keyword, MealPlan, MealType, NutritionInformation,
@@ -193,6 +193,7 @@ def rebuild_index(modeladmin, request, queryset):
             desc_search_vector=SearchVector('description__unaccent', weight='B', config=language)
         )
         Step.objects.all().update(search_vector=SearchVector('instruction__unaccent', weight='B', config=language))
+        update_search_document()
 
 
 class RecipeAdmin(admin.ModelAdmin):
@@ -1,4 +1,7 @@
-from django.db.models import Func
+import random
+
+from django.db.models import Func, Subquery
+from django.db.models.functions import Coalesce
 
 
 class Round(Func):
@@ -11,3 +14,29 @@ def str2bool(v):
         return v
     else:
         return v.lower() in ("yes", "true", "1")
+
+
+def random_sample(queryset, size):
+    """
+    Selects up to size random rows without sorting the whole queryset by random().
+    Rows are read in order of their random_key starting at a random pivot and wrapping around to the first key,
+    so the database only walks the (space, random_key) index. Models without random_key fall back to random().
+    """
+    if not hasattr(queryset.model, 'random_key'):
+        return queryset.order_by('?')[:size]
+    pivot = random.random()
+    ids = list(queryset.filter(random_key__gte=pivot).order_by('random_key').values_list('pk', flat=True)[:size])
+    if len(ids) < size:
+        ids += list(queryset.filter(random_key__lt=pivot).order_by('random_key').values_list('pk', flat=True)[:size - len(ids)])
+    return queryset.filter(pk__in=ids).order_by('random_key')
+
+
+def random_subquery(queryset, field):
+    """
+    Subquery for the value of field of one random row of queryset, see random_sample()
+    """
+    pivot = random.random()
+    return Coalesce(
+        Subquery(queryset.filter(random_key__gte=pivot).order_by('random_key').values(field)[:1]),
+        Subquery(queryset.order_by('random_key').values(field)[:1])
+    )
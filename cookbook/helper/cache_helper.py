@@ -0,0 +1,128 @@
+import time
+
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+from django.core.cache.backends.locmem import LocMemCache
+
+from recipes import settings
+
+
+class TieredCache(BaseCache):
+    """
+    Two level cache: a small in process LocMemCache (L1) in front of a cache that is shared by all workers (L2).
+    Values are read from L1 first and kept there for at most L1_TIMEOUT seconds, so a change made by another
+    worker is visible after that time at the latest.
+
+    OPTIONS:
+        SHARED: alias of the shared cache in settings.CACHES
+        L1_TIMEOUT: seconds a value is kept in process memory
+        L1_MAX_ENTRIES: maximum number of values kept in process memory
+    """
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self._shared_alias = options.get('SHARED', 'shared')
+        self._l1_timeout = int(options.get('L1_TIMEOUT', 5))
+        self._local = LocMemCache(location or 'tiered', {
+            'TIMEOUT': self._l1_timeout,
+            'OPTIONS': {'MAX_ENTRIES': int(options.get('L1_MAX_ENTRIES', 300))}
+        })
+
+    @property
+    def _shared(self):
+        return caches[self._shared_alias]
+
+    def _local_timeout(self, timeout):
+        if timeout is DEFAULT_TIMEOUT or timeout is None:
+            return self._l1_timeout
+        return min(timeout, self._l1_timeout)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        if added := self._shared.add(key, value, timeout=timeout, version=version):
+            self._local.set(key, value, timeout=self._local_timeout(timeout), version=version)
+        return added
+
+    def get(self, key, default=None, version=None):
+        value = self._local.get(key, self._missing_key, version=version)
+        if value is not self._missing_key:
+            return value
+        value = self._shared.get(key, self._missing_key, version=version)
+        if value is self._missing_key:
+            return default
+        self._local.set(key, value, version=version)
+        return value
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._shared.set(key, value, timeout=timeout, version=version)
+        self._local.set(key, value, timeout=self._local_timeout(timeout), version=version)
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        self._local.touch(key, timeout=self._local_timeout(timeout), version=version)
+        return self._shared.touch(key, timeout=timeout, version=version)
+
+    def delete(self, key, version=None):
+        self._local.delete(key, version=version)
+        return self._shared.delete(key, version=version)
+
+    def has_key(self, key, version=None):
+        return self._local.has_key(key, version=version) or self._shared.has_key(key, version=version)
+
+    def incr(self, key, delta=1, version=None):
+        value = self._shared.incr(key, delta=delta, version=version)
+        self._local.set(key, value, version=version)
+        return value
+
+    def get_many(self, keys, version=None):
+        found = self._local.get_many(keys, version=version)
+        missing = [k for k in keys if k not in found]
+        if missing:
+            shared = self._shared.get_many(missing, version=version)
+            self._local.set_many(shared, version=version)
+            found.update(shared)
+        return found
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        failed = self._shared.set_many(data, timeout=timeout, version=version)
+        self._local.set_many(data, timeout=self._local_timeout(timeout), version=version)
+        return failed
+
+    def delete_many(self, keys, version=None):
+        self._local.delete_many(keys, version=version)
+        self._shared.delete_many(keys, version=version)
+
+    def clear(self):
+        self._local.clear()
+        self._shared.clear()
+
+    def close(self, **kwargs):
+        self._shared.close(**kwargs)
+
+
+def get_space_data_version(space_id):
+    """
+    version of the recipe data of a space, part of the key of cached results computed from that data.
+    the version starts at the current time so a counter that was evicted from the cache never repeats a version.
+    it expires after CACHE_INVALIDATION_TIMEOUT so workers that did not see a bump with a per process cache catch up.
+    """
+    return caches['default'].get_or_set(f'space_data_version_{space_id}', time.time_ns(), settings.CACHE_INVALIDATION_TIMEOUT)
+
+
+def bump_space_data_version(space_id):
+    try:
+        caches['default'].incr(f'space_data_version_{space_id}')
+    except ValueError:
+        caches['default'].set(f'space_data_version_{space_id}', time.time_ns(), settings.CACHE_INVALIDATION_TIMEOUT)
+
+
+def get_meal_plans_changed(space_id):
+    """
+    time of the last change to the meal plans of a space or anything shown with them,
+    the time it was first asked for when the cache does not know it. The time expires after
+    CACHE_INVALIDATION_TIMEOUT so workers that did not see a change with a per process cache catch up.
+    """
+    return caches['default'].get_or_set(f'meal_plans_changed_{space_id}', time.time(), settings.CACHE_INVALIDATION_TIMEOUT)
+
+
+def touch_meal_plans(space_id):
+    caches['default'].set(f'meal_plans_changed_{space_id}', time.time(), settings.CACHE_INVALIDATION_TIMEOUT)
@@ -61,7 +61,7 @@ def is_object_owner(user, obj):
     if not user.is_authenticated:
         return False
     try:
-        return obj.get_owner() == user
+        return object_matches(obj, obj.owner_filter(user))
     except Exception:
         return False
 
@@ -75,11 +75,20 @@ def is_object_shared(user, obj):
     :param obj any object that should be tested
     :return: true if user is shared for object, false otherwise
     """
-    # TODO this could be improved/cleaned up by adding
-    #      share checks for relevant objects
     if not user.is_authenticated:
         return False
-    return user in obj.get_shared()
+    return object_matches(obj, obj.shared_filter(user))
+
+
+def object_matches(obj, q):
+    """
+    Tests if an object is matched by a filter of its model with a single query on its primary key
+    :param obj: saved model object
+    :param q: Q object of the objects model, e.g. from owner_filter or shared_filter
+    :return: true if the object matches the filter
+    """
+    # the base manager is not scoped, the object was already loaded from the users space
+    return type(obj)._base_manager.filter(q, pk=obj.pk).exists()
 
 
 def share_link_valid(recipe, share):
@@ -205,9 +214,6 @@ class CustomIsShared(permissions.BasePermission):
         return request.user.is_authenticated
 
     def has_object_permission(self, request, view, obj):
-        # temporary hack to make old shopping list work with new shopping list
-        if obj.__class__.__name__ in ['ShoppingList', 'ShoppingListEntry']:
-            return is_object_shared(request.user, obj) or obj.created_by in list(request.user.get_shopping_share())
         return is_object_shared(request.user, obj)
 
 
@@ -1,25 +1,48 @@
+import hashlib
+import json
 from collections import Counter
 from datetime import timedelta
 
+from django.contrib.postgres.aggregates import StringAgg
 from django.contrib.postgres.search import SearchQuery, SearchRank, TrigramSimilarity
 from django.core.cache import caches
-from django.db.models import Avg, Case, Count, F, Func, Max, OuterRef, Q, Subquery, Sum, Value, When
-from django.db.models.functions import Coalesce, Substr
+from django.db import connection
+from django.db.models import (Avg, Case, Count, F, FloatField, Func, Max, OuterRef, Q,
+                              Subquery, Sum, TextField, Value, When)
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import MD5, Cast, Coalesce, Substr
 from django.utils import timezone, translation
 from django.utils.translation import gettext as _
 
 from cookbook.filters import RecipeFilter
-from cookbook.helper.HelperFunctions import Round, str2bool
+from cookbook.helper.cache_helper import get_space_data_version
+from cookbook.helper.HelperFunctions import Round, random_sample, str2bool
 from cookbook.helper.permission_helper import has_group_permission
-from cookbook.managers import DICTIONARY
+from cookbook.managers import (DICTIONARY, FTS_TABLE, FTS_WEIGHTS, SEARCH_DOCUMENT_WEIGHTS,
+                               SearchDocumentFilter, Unaccent, fts_query, set_similarity_threshold,
+                               sqlite_fts_available)
 from cookbook.models import CookLog, Food, Keyword, Recipe, SearchPreference, ViewLog
 from recipes import settings
 
 
+def annotate_cooklog(queryset, user):
+    """
+    annotates the rating and last cooked date of the user as read by RecipeBaseSerializer
+    """
+    cooklog = CookLog.objects.filter(created_by=user, recipe=OuterRef('pk')).values('recipe')
+    return queryset.annotate(
+        recipe_rating=Subquery(cooklog.filter(rating__gt=0).annotate(avg=Avg('rating')).values('avg')),
+        recipe_last_cooked=Subquery(cooklog.annotate(last=Max('created_at')).values('last'))
+    )
+
+
 # TODO create extensive tests to make sure ORs ANDs and various filters, sorting, etc work as expected
 # TODO consider creating a simpleListRecipe API that only includes minimum of recipe info and minimal filtering
 class RecipeSearch():
     _postgres = settings.DATABASES['default']['ENGINE'] in ['django.db.backends.postgresql_psycopg2', 'django.db.backends.postgresql']
+    _sqlite = settings.DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3'
+    # parameters that select a page of the result, not the result
+    _page_params = ['page', 'page_size', 'cursor', 'count', 'debug']
 
     def __init__(self, request,  **params):
         self._request = request
@@ -71,11 +94,16 @@ class RecipeSearch():
                 search_type=self._search_type,
                 config=self._language,
             )
-            self.search_rank = (
-                SearchRank('name_search_vector', self.search_query, cover_density=True)
-                + SearchRank('desc_search_vector', self.search_query, cover_density=True)
-                + SearchRank('steps__search_vector', self.search_query, cover_density=True)
-            )
+            self.search_rank = SearchRank(F('search_vector'), self.search_query, cover_density=True)
+        elif self._sqlite and self._string and sqlite_fts_available():
+            self.search_query = fts_query(self._string, self._search_prefs.fulltext.values_list('field', flat=True))
+            if self.search_query:
+                self._fulltext_include = self._search_prefs.fulltext.values_list('field', flat=True)
+                # bm25 is lower for better matches, negate it to sort like the postgres rank
+                self.search_rank = Coalesce(RawSQL(
+                    f"SELECT -bm25({FTS_TABLE}, {', '.join(str(w) for w in FTS_WEIGHTS)}) FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s AND rowid = {Recipe._meta.db_table}.id",
+                    [self.search_query], output_field=FloatField()
+                ), 0.0)
         self.orderby = []
         self._default_sort = ['-favorite']  # TODO add user setting
         self._filters = None
@@ -85,6 +113,7 @@ class RecipeSearch():
         self._queryset = queryset
         self.recently_viewed_recipes(self._last_viewed)
         self._favorite_recipes()
+        self._cooklog_annotations()
         self._new_recipes()
         # self._last_viewed()
         # self._last_cooked()
@@ -100,9 +129,27 @@ class RecipeSearch():
         self._apply_order_by()
         return self._queryset.filter(space=self._request.space)
 
+    def get_cache_key(self):
+        """
+        identifies the ordered result of the search, it changes whenever recipe data of the space changes.
+        None if the result depends on data that is not versioned (random order, recently viewed recipes).
+        """
+        if self._random or self._last_viewed:
+            return None
+        params = {k: sorted(v) if isinstance(v, list) else v for k, v in self._params.items() if k not in self._page_params}
+        if self._string:
+            params['query'] = ' '.join(self._string.lower().split())
+            params['preferences'] = [self._search_type] + [
+                sorted(x or []) for x in [self._icontains_include, self._istartswith_include, self._trigram_include, self._fulltext_include]
+            ]
+        params_hash = hashlib.md5(json.dumps(params, sort_keys=True).encode()).hexdigest()
+        space = self._request.space.pk
+        return f'recipe_search_{space}_{self._request.user.pk}_{get_space_data_version(space)}_{params_hash}'
+
     def _apply_order_by(self):
         if self._random:
-            self._queryset = self._queryset.order_by("?")
+            # random results are shown as a single page
+            self._queryset = random_sample(self._queryset, int(self._params.get('page_size', 25)))
         else:
             if self._sort_order:
                 self._queryset.order_by(*self._sort_order)
@@ -135,6 +182,8 @@ class RecipeSearch():
         if self._postgres:
             self.build_fulltext_filters(self._string)
             self.build_trigram(self._string)
+        elif self._sqlite:
+            self.build_fts_filters(self._string)
 
         if self._filters:
             query_filter = None
@@ -143,7 +192,11 @@ class RecipeSearch():
                     query_filter |= f
                 else:
                     query_filter = f
-            self._queryset = self._queryset.filter(query_filter).distinct()
+            self._queryset = self._queryset.filter(query_filter)
+            # full text and trigram filters never join, only lookups on related fields can duplicate recipes
+            related_filters = any([self._keywords, self._foods, self._books, self._steps, self._units])
+            if related_filters or any('__' in f.replace('__unaccent', '') for f in [*self._icontains_include, *self._istartswith_include]):
+                self._queryset = self._queryset.distinct()
             # TODO add annotation for simularity
             if self._fulltext_include:
                 self._queryset = self._queryset.annotate(rank=self.search_rank)
@@ -182,6 +235,10 @@ class RecipeSearch():
                                                   ).values('recipe').annotate(count=Count('pk', distinct=True)).values('count')
         self._queryset = self._queryset.annotate(favorite=Coalesce(Subquery(favorite_recipes), 0))
 
+    def _cooklog_annotations(self):
+        # rating and last cooked date of the user are shown for every recipe in the result
+        self._queryset = annotate_cooklog(self._queryset, self._request.user)
+
     def keyword_filters(self, keywords=None, operator=True):
         if not keywords:
             return
@@ -259,16 +316,23 @@ class RecipeSearch():
         if self._fulltext_include:
             if not self._filters:
                 self._filters = []
-            if 'name' in self._fulltext_include:
-                self._filters += [Q(name_search_vector=self.search_query)]
-            if 'description' in self._fulltext_include:
-                self._filters += [Q(desc_search_vector=self.search_query)]
-            if 'steps__instruction' in self._fulltext_include:
-                self._filters += [Q(steps__search_vector=self.search_query)]
-            if 'keywords__name' in self._fulltext_include:
-                self._filters += [Q(keywords__in=Keyword.objects.filter(name__search=self.search_query))]
-            if 'steps__ingredients__food__name' in self._fulltext_include:
-                self._filters += [Q(steps__ingredients__food__in=Food.objects.filter(name__search=self.search_query))]
+            # all fields are part of the recipe search document, the GIN index finds the candidates
+            fulltext_filter = Q(search_vector=self.search_query)
+            weights = {SEARCH_DOCUMENT_WEIGHTS[f] for f in self._fulltext_include}
+            if weights != set(SEARCH_DOCUMENT_WEIGHTS.values()):
+                # only some fields are searched, recheck the candidates against the lexemes of those fields
+                self._queryset = self._queryset.annotate(fulltext_document=SearchDocumentFilter('search_vector', weights))
+                fulltext_filter &= Q(fulltext_document=self.search_query)
+            self._filters += [fulltext_filter]
+
+    def build_fts_filters(self, string=None):
+        if not string:
+            return
+        if self._fulltext_include:
+            if not self._filters:
+                self._filters = []
+            # the column filter of the fts query limits the match to the selected fields
+            self._filters += [Q(pk__in=RawSQL(f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', [self.search_query]))]
 
     def build_text_filters(self, string=None):
         if not string:
@@ -287,14 +351,23 @@ class RecipeSearch():
         if not string:
             return
         if self._trigram:
+            # the trigram operator can use the trigram indexes, similarity is only calculated for recipes that match
+            set_similarity_threshold(self._search_prefs.trigram_threshold)
+            fields = {}
+            trigram_filter = Q()
             trigram = None
-            for f in self._trigram_include:
+            for i, f in enumerate(self._trigram_include):
+                if f.endswith('__unaccent'):
+                    fields[f'trigram_{i}'], string = Unaccent(f[:-len('__unaccent')]), Unaccent(Value(self._string))
+                else:
+                    fields[f'trigram_{i}'], string = F(f), self._string
+                trigram_filter |= Q(**{f'trigram_{i}__trigram_similar': string})
                 if trigram:
-                    trigram += TrigramSimilarity(f, self._string)
+                    trigram += TrigramSimilarity(f'trigram_{i}', string)
                 else:
-                    trigram = TrigramSimilarity(f, self._string)
-            self._fuzzy_match = Recipe.objects.annotate(trigram=trigram).distinct(
-            ).annotate(simularity=Max('trigram')).values('id', 'simularity').filter(simularity__gt=self._search_prefs.trigram_threshold)
+                    trigram = TrigramSimilarity(f'trigram_{i}', string)
+            self._fuzzy_match = Recipe.objects.filter(space=self._request.space).annotate(**fields).filter(trigram_filter
+                                                                                                          ).values('id').annotate(simularity=Max(trigram)).values('id', 'simularity')
             self._filters += [Q(pk__in=self._fuzzy_match.values('pk'))]
 
 
@@ -478,6 +551,8 @@ class RecipeSearch():
 
 
 class RecipeFacet():
+    _postgres = settings.DATABASES['default']['ENGINE'] in ['django.db.backends.postgresql_psycopg2', 'django.db.backends.postgresql']
+
     class CacheEmpty(Exception):
         pass
 
@@ -487,7 +562,7 @@ class RecipeFacet():
 
         self._request = request
         self._queryset = queryset
-        self.hash_key = hash_key or str(hash(frozenset(self._queryset.values_list('pk'))))
+        self.hash_key = hash_key or self._fingerprint(self._queryset)
         self._SEARCH_CACHE_KEY = f"recipes_filter_{self.hash_key}"
         self._cache_timeout = cache_timeout
         self._cache = caches['default'].get(self._SEARCH_CACHE_KEY, {})
@@ -502,7 +577,10 @@ class RecipeFacet():
         self.Recent = self._cache.get('Recent', None)
 
         if self._queryset is not None:
-            self._recipe_list = list(self._queryset.values_list('id', flat=True))
+            # the recipes are never loaded, facets are counted with the search as subquery
+            self._recipe_list = self._queryset.values('id')
+            # the parameters of the search are cached instead of the query so it can be built again for later requests
+            self._search = {x: request.GET.get(x) if len(request.GET.getlist(x)) == 1 else request.GET.getlist(x) for x in request.GET}
             self._search_params = {
                 'keyword_list': self._request.query_params.getlist('keywords', []),
                 'food_list': self._request.query_params.getlist('foods', []),
@@ -513,7 +591,10 @@ class RecipeFacet():
                 'space': self._request.space,
             }
         elif self.hash_key is not None:
-            self._recipe_list = self._cache.get('recipe_list', [])
+            self._search = self._cache.get('search', None)
+            self._recipe_list = Recipe.objects.none()
+            if self._search is not None:
+                self._recipe_list = RecipeSearch(request, **self._search).get_queryset(Recipe.objects.filter(space=request.space)).values('id')
             self._search_params = {
                 'keyword_list': self._cache.get('keyword_list', None),
                 'food_list': self._cache.get('food_list', None),
@@ -526,7 +607,7 @@ class RecipeFacet():
 
         self._cache = {
             **self._search_params,
-            'recipe_list': self._recipe_list,
+            'search': self._search,
             'Ratings': self.Ratings,
             'Recent': self.Recent,
             'Keywords': self.Keywords,
@@ -536,6 +617,20 @@ class RecipeFacet():
         }
         caches['default'].set(self._SEARCH_CACHE_KEY, self._cache, self._cache_timeout)
 
+    def _fingerprint(self, queryset):
+        """
+        identifies the set of recipes in a search result, calculated by the database so ids are not loaded
+        """
+        recipes = Recipe.objects.filter(id__in=queryset.values('id'))
+        if self._postgres:
+            return recipes.aggregate(fingerprint=MD5(StringAgg(Cast('id', output_field=TextField()), delimiter=',', ordering='id', output_field=TextField())))['fingerprint'] or ''
+        # sqlite has no md5 and group_concat takes no ordering before 3.44, the ids are concatenated in an ordered subquery
+        sql, params = recipes.order_by('id').values('id').query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT group_concat(id, ',') FROM ({sql})", params)
+            ids = cursor.fetchone()[0]
+        return hashlib.md5(ids.encode()).hexdigest() if ids else ''
+
     def get_facets(self, from_cache=False):
         if from_cache:
             return {
@@ -607,7 +702,7 @@ class RecipeFacet():
                 if self._queryset is None:
                     self._queryset = Recipe.objects.filter(id__in=self._recipe_list)
                 rating_qs = self._queryset.annotate(rating=Round(Avg(Case(When(cooklog__created_by=self._request.user, then='cooklog__rating'), default=Value(0)))))
-                self.Ratings = dict(Counter(r.rating for r in rating_qs))
+                self.Ratings = dict(Counter(rating_qs.values_list('rating', flat=True)))
             else:
                 self.Rating = {}
             self.set_cache('Ratings', self.Ratings)
@@ -654,32 +749,32 @@ class RecipeFacet():
         self.set_cache('Keywords', self.Keywords)
         return self.get_facets()
 
-    def _recipe_count_queryset(self, field, depth=1, steplen=4):
-        return Recipe.objects.filter(**{f'{field}__path__startswith': OuterRef('path')}, id__in=self._recipe_list, space=self._request.space
-                                     ).values(child=Substr(f'{field}__path',  1, steplen)
-                                              ).annotate(count=Count('pk', distinct=True)).values('count')
+    def _recipe_counts(self, model, relation, depth, parent=None):
+        """
+        number of recipes in the search result per node of one tree level in a single grouped query,
+        recipes of descendants are counted for the node as their paths start with the path of the node
+        """
+        nodes = model.objects.filter(**{f'{relation}__in': self._recipe_list}, depth__gte=depth, space=self._request.space)
+        if parent:
+            nodes = nodes.filter(path__startswith=parent.path)
+        counts = nodes.values(node_path=Substr('path', 1, depth * model.steplen)).annotate(count=Count(relation, distinct=True)).order_by()
+        return {x['node_path']: x['count'] for x in counts}
 
-    def _keyword_queryset(self, queryset, keyword=None):
-        depth = getattr(keyword, 'depth', 0) + 1
-        steplen = depth * Keyword.steplen
+    def _tree_facet(self, model, relation, queryset, parent=None):
+        depth = getattr(parent, 'depth', 0) + 1
 
         if not self._request.space.demo and self._request.space.show_facet_count:
-            return queryset.annotate(count=Coalesce(Subquery(self._recipe_count_queryset('keywords', depth, steplen)), 0)
-                                     ).filter(depth=depth, count__gt=0
-                                              ).values('id', 'name', 'count', 'numchild').order_by('name')[:200]
+            counts = self._recipe_counts(model, relation, depth, parent)
+            nodes = queryset.filter(depth=depth).values('id', 'name', 'numchild', 'path').order_by('name')
+            return [{'id': x['id'], 'name': x['name'], 'count': counts[x['path']], 'numchild': x['numchild']} for x in nodes if x['path'] in counts][:200]
         else:
-            return queryset.filter(depth=depth).values('id', 'name',  'numchild').order_by('name')
+            return queryset.filter(depth=depth).values('id', 'name', 'numchild').order_by('name')
 
-    def _food_queryset(self, queryset, food=None):
-        depth = getattr(food, 'depth', 0) + 1
-        steplen = depth * Food.steplen
+    def _keyword_queryset(self, queryset, keyword=None):
+        return self._tree_facet(Keyword, 'recipe', queryset, keyword)
 
-        if not self._request.space.demo and self._request.space.show_facet_count:
-            return queryset.annotate(count=Coalesce(Subquery(self._recipe_count_queryset('steps__ingredients__food', depth, steplen)), 0)
-                                     ).filter(depth__lte=depth, count__gt=0
-                                              ).values('id', 'name', 'count', 'numchild').order_by('name')[:200]
-        else:
-            return queryset.filter(depth__lte=depth).values('id', 'name', 'numchild').order_by('name')
+    def _food_queryset(self, queryset, food=None):
+        return self._tree_facet(Food, 'ingredient__step__recipe', queryset, food)
 
 
 # # TODO:  This might be faster https://github.com/django-treebeard/django-treebeard/issues/115
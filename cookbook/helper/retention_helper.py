@@ -0,0 +1,109 @@
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.db import connection, transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+from django_scopes import scopes_disabled
+
+from cookbook.models import (CookLog, ImportLog, ShoppingListEntry, ShoppingListEntryTombstone,
+                             Space, SyncLog, ViewLog)
+from recipes import settings
+
+# history that is deleted after the retention days of its space: model, lookup of the space, date field and rows that may be deleted
+RETENTION = {
+    'shopping': (ShoppingListEntry, 'space', 'completed_at', Q(checked=True)),
+    'view_log': (ViewLog, 'space', 'created_at', Q()),
+    'cook_log': (CookLog, 'space', 'created_at', Q()),
+    'sync_log': (SyncLog, 'sync__space', 'created_at', Q()),
+    'import_log': (ImportLog, 'space', 'created_at', Q(running=False)),
+}
+
+# key of the postgres advisory lock held while history is deleted
+RETENTION_LOCK = 7283901
+
+# sync data of shopping lists, kept SHOPPING_SYNC_RETENTION_DAYS for all spaces
+SYNC_RETENTION = {
+    'shopping_tombstone': (ShoppingListEntryTombstone, 'deleted_at'),
+}
+
+
+def retention_days(space, name):
+    """
+    days the history name of space is kept, 0 keeps it forever
+    """
+    days = getattr(space, f'{name}_retention_days')
+    return getattr(settings, f'{name.upper()}_RETENTION_DAYS') if days is None else days
+
+
+def delete_in_batches(queryset, batch_size):
+    """
+    deletes the rows of queryset in transactions of at most batch_size rows so tables are never locked for long
+    :return: number of deleted rows
+    """
+    deleted = 0
+    while ids := list(queryset.order_by().values_list('id', flat=True)[:batch_size]):
+        with transaction.atomic():
+            # deleted through the orm so signals and cascades are applied as for any other delete
+            queryset.model.objects.filter(id__in=ids).delete()
+        deleted += len(ids)
+    return deleted
+
+
+@contextmanager
+def retention_lock():
+    """
+    advisory lock of the database session on postgres, so only one process of all servers deletes history at a time.
+    sqlite databases are only used by one server and write one transaction at a time
+    :return: True if the lock was acquired, False while another process holds it
+    """
+    if connection.vendor != 'postgresql':
+        yield True
+        return
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_try_advisory_lock(%s)', [RETENTION_LOCK])
+        locked = cursor.fetchone()[0]
+    try:
+        yield locked
+    finally:
+        if locked:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_unlock(%s)', [RETENTION_LOCK])
+
+
+def delete_old_history(spaces=None, batch_size=None, dry_run=False):
+    """
+    deletes history that is older than its retention days
+    :param spaces: spaces to clean, all spaces and the sync data of deleted spaces by default
+    :param dry_run: count the rows instead of deleting them
+    :return: dict of history name to number of deleted rows, None if another process is deleting history
+    """
+    if dry_run:
+        return _delete_old_history(spaces, batch_size, dry_run)
+    with retention_lock() as locked:
+        return _delete_old_history(spaces, batch_size, dry_run) if locked else None
+
+
+def _delete_old_history(spaces, batch_size, dry_run):
+    batch_size = batch_size or settings.RETENTION_BATCH_SIZE
+    now = timezone.now()
+    counts = {name: 0 for name in [*RETENTION, *SYNC_RETENTION]}
+
+    with scopes_disabled():
+        for space in (spaces or Space.objects.all()):
+            for name, (model, space_lookup, date_field, condition) in RETENTION.items():
+                if days := retention_days(space, name):
+                    rows = model.objects.filter(condition, **{space_lookup: space, f'{date_field}__lt': now - timedelta(days=days)})
+                    counts[name] += rows.count() if dry_run else delete_in_batches(rows, batch_size)
+
+        for name, (model, date_field) in SYNC_RETENTION.items():
+            rows = model.objects.none()
+            if days := settings.SHOPPING_SYNC_RETENTION_DAYS:
+                rows = model.objects.filter(**{f'{date_field}__lt': now - timedelta(days=days)})
+            if spaces:
+                rows = rows.filter(space__in=spaces)
+            else:
+                # sync data has no foreign key constraint and outlives its space
+                rows = rows | model.objects.filter(~Exists(Space.objects.filter(id=OuterRef('space_id'))))
+            counts[name] += rows.count() if dry_run else delete_in_batches(rows, batch_size)
+    return counts
@@ -1,29 +1,79 @@
 from datetime import timedelta
 from decimal import Decimal
+from functools import partial
 
+from django.contrib.auth.models import User
 from django.contrib.postgres.aggregates import ArrayAgg
-from django.db.models import F, OuterRef, Q, Subquery, Value
-from django.db.models.functions import Coalesce
+from django.db import transaction
+from django.core.cache import caches
+from django.db.models import (Aggregate, BooleanField, Case, CharField, DateTimeField, Exists, F, IntegerField,
+                              OuterRef, Prefetch, Q, Sum, Value, When)
+from django.db.transaction import atomic
 from django.utils import timezone
 from django.utils.translation import gettext as _
+from django_scopes import scopes_disabled
 
 from cookbook.helper.HelperFunctions import Round, str2bool
-from cookbook.models import (Ingredient, ShoppingListEntry, ShoppingListRecipe,
-                             SupermarketCategoryRelation)
+from cookbook.models import (Food, Ingredient, MealPlan, ShoppingListEntry, ShoppingListRecipe,
+                             Space, SupermarketCategoryRelation)
 from recipes import settings
 
 
+def onhand_status(user, food='pk'):
+    """
+    annotation telling if the food is on hand for the user or a user sharing their shopping list with them
+    """
+    return Exists(Food.onhand_users.through.objects.filter(food_id=OuterRef(food), user_id__in=[*user.get_shopping_share_ids(), user.id]))
+
+
+def onhand_prefetch(user, lookup='food__onhand_users'):
+    """
+    loads the users a food is on hand for that are relevant to user into food.shared_onhand_users,
+    used for foods loaded through select_related that cannot be annotated
+    """
+    return Prefetch(lookup, queryset=User.objects.filter(id__in=[*user.get_shopping_share_ids(), user.id]).only('id'), to_attr='shared_onhand_users')
+
+
+def supermarket_order_cache_key(supermarket_id):
+    return f'supermarket_order_{supermarket_id}'
+
+
+def get_supermarket_order(supermarket, space):
+    """
+    order of the categories in a supermarket, cached until one of its category relations changes or at most
+    CACHE_INVALIDATION_TIMEOUT seconds
+    :return: dict of category id to order, categories not in the supermarket are missing
+    """
+    cache_key = supermarket_order_cache_key(supermarket)
+    if (cached := caches['default'].get(cache_key, None)) is None:
+        supermarket_space, category_order = None, {}
+        with scopes_disabled():
+            # read for any space, the result is shared by all requests for the supermarket
+            relations = list(SupermarketCategoryRelation.objects.filter(supermarket=supermarket).order_by('-order').values_list(
+                'category', 'order', 'supermarket__space'
+            ))
+        for category, order, supermarket_space in relations:
+            # a category listed twice is sorted by its first position
+            category_order[category] = order
+        cached = (supermarket_space, category_order)
+        caches['default'].set(cache_key, cached, settings.CACHE_INVALIDATION_TIMEOUT)
+    # the key holds no space, the order of a supermarket of another space is never used
+    supermarket_space, category_order = cached
+    return category_order if supermarket_space == space.id else {}
+
+
 def shopping_helper(qs, request):
     supermarket = request.query_params.get('supermarket', None)
     checked = request.query_params.get('checked', 'recent')
     user = request.user
     supermarket_order = [F('food__supermarket_category__name').asc(nulls_first=True), 'food__name']
 
-    # TODO created either scheduled task or startup task to delete very old shopping list entries
-    # TODO create user preference to define 'very old'
     if supermarket:
-        supermarket_categories = SupermarketCategoryRelation.objects.filter(supermarket=supermarket, category=OuterRef('food__supermarket_category'))
-        qs = qs.annotate(supermarket_order=Coalesce(Subquery(supermarket_categories.values('order')), Value(9999)))
+        category_order = get_supermarket_order(int(supermarket), request.space)
+        qs = qs.annotate(supermarket_order=Case(
+            *[When(food__supermarket_category=category, then=Value(order)) for category, order in category_order.items()],
+            default=Value(9999), output_field=IntegerField()
+        ))
         supermarket_order = ['supermarket_order'] + supermarket_order
     if checked in ['false', 0, '0']:
         qs = qs.filter(checked=False)
@@ -32,22 +82,106 @@ def shopping_helper(qs, request):
     elif checked in ['recent']:
         today_start = timezone.now().replace(hour=0, minute=0, second=0)
         week_ago = today_start - timedelta(days=user.userpreference.shopping_recent_days)
-        qs = qs.filter(Q(checked=False) | Q(completed_at__gte=week_ago))
+        qs = qs.filter(Q(checked=False) | Q(checked=True, completed_at__gte=week_ago))
         supermarket_order = ['checked'] + supermarket_order
 
-    return qs.order_by(*supermarket_order).select_related('unit', 'food', 'ingredient', 'created_by', 'list_recipe', 'list_recipe__mealplan', 'list_recipe__recipe')
+    return qs.order_by(*supermarket_order).select_related(
+        'unit', 'food', 'ingredient', 'created_by', 'list_recipe', 'list_recipe__mealplan', 'list_recipe__recipe'
+    ).prefetch_related(onhand_prefetch(user), 'food__inherit_fields')
+
+
+class GroupConcat(Aggregate):
+    # sqlite counterpart of ArrayAgg, the values are joined with the ascii unit separator
+    function = 'GROUP_CONCAT'
+    template = '%(function)s(%(expressions)s, char(31))'
+    output_field = CharField()
+
+
+def shopping_aggregate(qs, delayed=False):
+    """
+    merges the entries of a shopping list that share food, unit, checked and delayed state, summing their amounts.
+    every row keeps the ids of the merged entries and the names of the recipes they were added for
+    :param qs: shopping list entries, filtered and ordered by shopping_helper
+    :param delayed: include entries that are delayed, by default they are hidden as in the shopping list
+    """
+    now = timezone.now()
+    if not delayed:
+        qs = qs.filter(Q(delay_until__isnull=True) | Q(delay_until__lte=now))
+    qs = qs.annotate(delayed=Case(When(delay_until__gt=now, then=Value(True)), default=Value(False), output_field=BooleanField()))
+
+    postgres = settings.DATABASES['default']['ENGINE'] in ['django.db.backends.postgresql_psycopg2', 'django.db.backends.postgresql']
+    if postgres:
+        entries = ArrayAgg('id', ordering='id')
+        recipes = ArrayAgg('list_recipe__recipe__name', distinct=True, filter=Q(list_recipe__recipe__isnull=False))
+    else:
+        entries = GroupConcat('id')
+        recipes = GroupConcat('list_recipe__recipe__name')
+
+    rows = list(qs.select_related(None).prefetch_related(None).values(
+        'food', 'food__name', 'unit', 'unit__name', 'food__supermarket_category', 'food__supermarket_category__name', 'checked', 'delayed'
+    ).annotate(amount=Sum('amount'), entries=entries, recipes=recipes))
+
+    for row in rows:
+        if not postgres:
+            row['entries'] = sorted(int(x) for x in row['entries'].split('\x1f'))
+            row['recipes'] = row['recipes'].split('\x1f') if row['recipes'] else []
+        row['recipes'] = sorted(set(row['recipes'] or []))
+    return rows
+
+
+def load_shopping_ingredients(recipes, created_by, space):
+    """
+    Reads the ingredients list_from_recipe adds to the shopping list of created_by for all recipes at once
+    :param recipes: Recipes to load, related recipes shared by several of them are only read once
+    :return: dict of recipe id to (ingredients, related recipe ids, ingredients of the related recipes)
+    """
+    shared_users = [*created_by.get_shopping_share_ids(), created_by.id]
+    recipe_ids = {r.id for r in recipes}
+
+    ingredients = Ingredient.objects.filter(step__recipe__in=recipe_ids, food__ignore_shopping=False, space=space)
+    if exclude_onhand := created_by.userpreference.mealplan_autoexclude_onhand:
+        ingredients = ingredients.exclude(food__onhand_users__id__in=shared_users)
+    ingredients = list(ingredients.annotate(food_recipe=F('food__recipe'), source_recipe=F('step__recipe')))
+
+    related_recipes = {r: [] for r in recipe_ids}
+    related_step_ing = []
+    if created_by.userpreference.mealplan_autoinclude_related:
+        # all levels of sub recipes are added
+        related_recipes = {r.id: r.get_related_recipe_ids() for r in {r.id: r for r in recipes}.values()}
+        # related recipe is a Step serving size is driven by recipe serving size
+        # TODO once/if Steps can have a serving size this needs to be refactored
+        # if steps are used more than once in a recipe or subrecipe - I don' think this results in the desired behavior
+        related_step_ing = Ingredient.objects.filter(step__recipe__in={x for r in related_recipes.values() for x in r}, space=space)
+        if exclude_onhand:
+            related_step_ing = related_step_ing.exclude(food__onhand_users__id__in=shared_users)
+        related_step_ing = list(related_step_ing.annotate(
+            related_recipe=F('step__recipe'), food_ignore_shopping=F('food__ignore_shopping'), food_recipe=F('food__recipe')
+        ))
+
+    return {
+        r: (
+            [i for i in ingredients if i.source_recipe == r],
+            related_recipes[r],
+            # foods of sub recipes that are recipes themselves are replaced by the ingredients of their recipe
+            [i for i in related_step_ing if i.related_recipe in related_recipes[r] and i.food_recipe not in related_recipes[r]]
+        ) for r in recipe_ids
+    }
 
 
 # TODO refactor as class
-def list_from_recipe(list_recipe=None, recipe=None, mealplan=None, servings=None, ingredients=None, created_by=None, space=None, append=False):
+@atomic
+def list_from_recipe(list_recipe=None, recipe=None, mealplan=None, servings=None, ingredients=None, created_by=None, space=None, append=False,
+                     loaded_ingredients=None):
     """
     Creates ShoppingListRecipe and associated ShoppingListEntrys from a recipe or a meal plan with a recipe
+    The entries are calculated in memory from a fixed number of queries and written with bulk operations.
     :param list_recipe: Modify an existing ShoppingListRecipe
     :param recipe: Recipe to use as list of ingredients.  One of [recipe, mealplan] are required
     :param mealplan: alternatively use a mealplan recipe as source of ingredients
     :param servings: Optional: Number of servings to use to scale shoppinglist.  If servings = 0 an existing recipe list will be deleted
     :param ingredients: Ingredients, list of ingredient IDs to include on the shopping list.  When not provided all ingredients will be used
     :param append: If False will remove any entries not included with ingredients, when True will append ingredients to the shopping list
+    :param loaded_ingredients: Optional: result of load_shopping_ingredients containing the recipe, read when not provided
     """
     r = recipe or getattr(mealplan, 'recipe', None) or getattr(list_recipe, 'recipe', None)
     if not r:
@@ -64,8 +198,6 @@ def list_from_recipe(list_recipe=None, recipe=None, mealplan=None, servings=None
 
     servings_factor = servings / r.servings
 
-    shared_users = list(created_by.get_shopping_share())
-    shared_users.append(created_by)
     if list_recipe:
         created = False
     else:
@@ -73,83 +205,146 @@ def list_from_recipe(list_recipe=None, recipe=None, mealplan=None, servings=None
         created = True
 
     related_step_ing = []
+    related_entries = []
     if servings == 0 and not created:
         list_recipe.delete()
         return []
     elif ingredients:
-        ingredients = Ingredient.objects.filter(pk__in=ingredients, space=space)
+        ingredients = list(Ingredient.objects.filter(pk__in=ingredients, space=space))
     else:
-        ingredients = Ingredient.objects.filter(step__recipe=r,  food__ignore_shopping=False, space=space)
-
-        if exclude_onhand := created_by.userpreference.mealplan_autoexclude_onhand:
-            ingredients = ingredients.exclude(food__onhand_users__id__in=[x.id for x in shared_users])
-
-        if related := created_by.userpreference.mealplan_autoinclude_related:
-            # TODO: add levels of related recipes (related recipes of related recipes) to use when auto-adding mealplans
-            related_recipes = r.get_related_recipes()
-
-            for x in related_recipes:
-                # related recipe is a Step serving size is driven by recipe serving size
-                # TODO once/if Steps can have a serving size this needs to be refactored
-                if exclude_onhand:
-                    # if steps are used more than once in a recipe or subrecipe - I don' think this results in the desired behavior
-                    related_step_ing += Ingredient.objects.filter(step__recipe=x, space=space).exclude(food__onhand_users__id__in=[x.id for x in shared_users]).values_list('id', flat=True)
-                else:
-                    related_step_ing += Ingredient.objects.filter(step__recipe=x, space=space).values_list('id', flat=True)
-
-                x_ing = []
-                if ingredients.filter(food__recipe=x).exists():
-                    for ing in ingredients.filter(food__recipe=x):
-                        if exclude_onhand:
-                            x_ing = Ingredient.objects.filter(step__recipe=x,  food__ignore_shopping=False, space=space).exclude(food__onhand_users__id__in=[x.id for x in shared_users])
-                        else:
-                            x_ing = Ingredient.objects.filter(step__recipe=x,  food__ignore_shopping=False, space=space).exclude(food__ignore_shopping=True)
-                        for i in [x for x in x_ing]:
-                            ShoppingListEntry.objects.create(
-                                list_recipe=list_recipe,
-                                food=i.food,
-                                unit=i.unit,
-                                ingredient=i,
-                                amount=i.amount * Decimal(servings_factor),
-                                created_by=created_by,
-                                space=space,
-                            )
-                # dont' add food to the shopping list that are actually recipes that will be added as ingredients
-                ingredients = ingredients.exclude(food__recipe=x)
-
-    add_ingredients = list(ingredients.values_list('id', flat=True)) + related_step_ing
+        if loaded_ingredients is None:
+            loaded_ingredients = load_shopping_ingredients([r], created_by, space)
+        ingredients, related_recipes, related_step_ing = loaded_ingredients[r.id]
+
+        for x in related_recipes:
+            x_ing = [i for i in related_step_ing if i.related_recipe == x and i.food_ignore_shopping is False]
+            for ing in [i for i in ingredients if i.food_recipe == x]:
+                related_entries += [
+                    ShoppingListEntry(
+                        list_recipe=list_recipe,
+                        food_id=i.food_id,
+                        unit_id=i.unit_id,
+                        ingredient_id=i.id,
+                        amount=i.amount * Decimal(servings_factor),
+                        created_by=created_by,
+                        space=space,
+                    ) for i in x_ing
+                ]
+        # dont' add food to the shopping list that are actually recipes that will be added as ingredients
+        ingredients = [i for i in ingredients if i.food_recipe not in related_recipes]
+
+    ingredient_ids = {i.id for i in ingredients}
+    add_ingredients = {i.id: i for i in [*ingredients, *related_step_ing]}
     if not append:
-        existing_list = ShoppingListEntry.objects.filter(list_recipe=list_recipe)
-        # delete shopping list entries not included in ingredients
-        existing_list.exclude(ingredient__in=ingredients).delete()
+        # entries not included in ingredients are deleted, including those of related recipes that were just calculated
+        related_entries = [x for x in related_entries if x.ingredient_id in ingredient_ids]
+        existing = {x.ingredient_id for x in related_entries}
+        if not created:
+            existing_list = ShoppingListEntry.objects.filter(list_recipe=list_recipe)
+            existing_list.exclude(ingredient__in=ingredient_ids).delete()
+            existing |= set(existing_list.values_list('ingredient__id', flat=True))
         # add shopping list entries that did not previously exist
-        add_ingredients = set(add_ingredients) - set(existing_list.values_list('ingredient__id', flat=True))
-    add_ingredients = Ingredient.objects.filter(id__in=add_ingredients, space=space)
+        add_ingredients = {k: v for k, v in add_ingredients.items() if k not in existing}
 
     # if servings have changed, update the ShoppingListRecipe and existing Entries
     if servings <= 0:
         servings = 1
 
     if not created and list_recipe.servings != servings:
-        update_ingredients = set(ingredients.values_list('id', flat=True)) - set(add_ingredients.values_list('id', flat=True))
+        update_ingredients = {i.id: i for i in ingredients if i.id not in add_ingredients}
         list_recipe.servings = servings
         list_recipe.save()
-        for sle in ShoppingListEntry.objects.filter(list_recipe=list_recipe, ingredient__id__in=update_ingredients):
-            sle.amount = sle.ingredient.amount * Decimal(servings_factor)
-            sle.save()
+        update_entries = list(ShoppingListEntry.objects.filter(list_recipe=list_recipe, ingredient__id__in=update_ingredients.keys()).only('id', 'ingredient'))
+        for sle in update_entries:
+            sle.amount = update_ingredients[sle.ingredient_id].amount * Decimal(servings_factor)
+            sle.updated_at = timezone.now()
+        ShoppingListEntry.objects.bulk_update(update_entries, ['amount', 'updated_at'])
 
     # add any missing Entries
-    for i in [x for x in add_ingredients if x.food]:
-
-        ShoppingListEntry.objects.create(
+    ShoppingListEntry.objects.bulk_create(related_entries + [
+        ShoppingListEntry(
             list_recipe=list_recipe,
-            food=i.food,
-            unit=i.unit,
-            ingredient=i,
+            food_id=i.food_id,
+            unit_id=i.unit_id,
+            ingredient_id=i.id,
             amount=i.amount * Decimal(servings_factor),
             created_by=created_by,
             space=space,
-        )
+        ) for i in sorted(add_ingredients.values(), key=lambda x: (x.order, x.id)) if i.food_id
+    ])
 
     # return all shopping list items
     return list_recipe
+
+
+@atomic
+def list_from_mealplans(mealplans, space, created_by=None):
+    """
+    Adds the recipes of many meal plans to the shopping list in one pass, the ingredients of all recipes are read at once
+    Meal plans without a recipe or that already are on a shopping list are skipped
+    :param mealplans: queryset of MealPlans
+    :param space: space of the meal plans
+    :param created_by: Optional: owner of the shopping list, the owner of every meal plan when not provided
+    :return: the created ShoppingListRecipes
+    """
+    mealplans = list(mealplans.filter(recipe__isnull=False, shoppinglistrecipe__isnull=True).select_related('recipe', 'created_by').order_by('date', 'id'))
+
+    owners = {}
+    for plan in mealplans:
+        owners.setdefault(created_by or plan.created_by, []).append(plan)
+
+    list_recipes = []
+    for owner, plans in owners.items():
+        loaded_ingredients = load_shopping_ingredients([plan.recipe for plan in plans], owner, space)
+        for plan in plans:
+            list_recipes.append(list_from_recipe(mealplan=plan, servings=plan.servings, created_by=owner, space=space, loaded_ingredients=loaded_ingredients))
+    return list_recipes
+
+
+def add_mealplan_after_commit(mealplan):
+    """
+    Adds the meal plan to the shopping list of its owner once the transaction commits, so saving a meal plan
+    stays fast. The callback is dropped with the meal plan when the transaction rolls back, many meal plans are
+    added together by the shopping action of the meal plan api.
+    """
+    transaction.on_commit(partial(_add_committed_mealplan, mealplan.id, mealplan.space_id))
+
+
+def _add_committed_mealplan(mealplan_id, space_id):
+    with scopes_disabled():
+        if space := Space.objects.filter(id=space_id).first():
+            list_from_mealplans(
+                MealPlan.objects.filter(id=mealplan_id, space=space, created_by__userpreference__mealplan_autoadd_shopping=True), space
+            )
+
+
+@atomic
+def bulk_update_entries(entries, user, changes):
+    """
+    Checks, unchecks or delays many shopping list entries with one UPDATE
+    :param entries: queryset of the ShoppingListEntrys to change
+    :param user: user making the change, when shopping_add_onhand is set the foods become on hand for the user and
+    the users they share their shopping list with
+    :param changes: dict with checked and/or delay_until, a delay_until of None removes the delay
+    :return: ids of the changed entries
+    """
+    entries = list(entries.only('id', 'food'))
+    now = timezone.now()
+    values = {'updated_at': now}
+    if 'delay_until' in changes:
+        values['delay_until'] = changes['delay_until']
+    if (checked := changes.get('checked', None)) is not None:
+        values['checked'] = checked
+        # entries that already are checked keep their completion date
+        values['completed_at'] = Case(When(checked=True, then=F('completed_at')), default=Value(now), output_field=DateTimeField()) if checked else None
+    ShoppingListEntry.objects.filter(id__in=[e.id for e in entries]).update(**values)
+
+    if checked is not None and user.userpreference.shopping_add_onhand:
+        users = [user.id, *user.userpreference.shopping_share.values_list('id', flat=True)]
+        foods = {e.food_id for e in entries}
+        onhand = Food.onhand_users.through
+        if checked:
+            onhand.objects.bulk_create([onhand(food_id=f, user_id=u) for f in foods for u in users], ignore_conflicts=True)
+        else:
+            onhand.objects.filter(food_id__in=foods, user_id__in=users).delete()
+    return [e.id for e in entries]
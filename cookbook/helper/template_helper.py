@@ -1,12 +1,18 @@
+import hashlib
+import json
+
 import bleach
 import markdown as md
 from bleach_allowlist import markdown_attrs, markdown_tags
+from django.core.cache import caches
 from cookbook.helper.mdx_attributes import MarkdownFormatExtension
 from cookbook.helper.mdx_urlize import UrlizeExtension
 from jinja2 import Template, TemplateSyntaxError, UndefinedError
 from gettext import gettext as _
 from markdown.extensions.tables import TableExtension
 
+RENDER_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+
 class IngredientObject(object):
     amount = ""
     unit = ""
@@ -63,3 +69,22 @@ def render_instructions(step):  # TODO deduplicate markdown cleanup code
         return _('Could not parse template code.') + ' Error: Undefined Error'
 
     return instructions
+
+
+def render_cache_key(step):
+    """
+    the rendered instruction only depends on the instruction and the ingredients of the step, the key is a hash of
+    both so an edit always uses a new key and an outdated rendering can never be returned
+    """
+    content = [step.instruction, [
+        [str(i.amount), i.no_amount, str(i.unit) if i.unit else '', str(i.food), str(i.note)] for i in step.ingredients.all()
+    ]]
+    return f'step_render_{hashlib.sha256(json.dumps(content).encode()).hexdigest()}'
+
+
+def render_instructions_cached(step):
+    key = render_cache_key(step)
+    if (instructions := caches['default'].get(key, None)) is None:
+        instructions = render_instructions(step)
+        caches['default'].set(key, instructions, RENDER_CACHE_TIMEOUT)
+    return instructions
@@ -0,0 +1,57 @@
+import time
+import traceback
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils.translation import gettext_lazy as _
+from django_scopes import scopes_disabled
+
+from cookbook.helper.retention_helper import delete_old_history
+from cookbook.models import Space
+from recipes import settings
+
+
+# can be executed at the command line with 'python manage.py cleanuphistory', for example from a daily cron job.
+# boot.sh starts it with --schedule next to the server
+class Command(BaseCommand):
+    help = _('Deletes shopping list entries and logs that are older than the retention days of their space')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--space', type=int, action='append', help=_('Only clean this space, can be given more than once'))
+        parser.add_argument('--batch-size', type=int, help=_('Rows deleted per transaction'))
+        parser.add_argument('--dry-run', action='store_true', help=_('Count the rows that would be deleted'))
+        parser.add_argument('--schedule', action='store_true', help=_('Keep running and clean up every RETENTION_INTERVAL hours, exits if it is 0'))
+
+    def handle(self, *args, **options):
+        spaces = None
+        if options['space']:
+            with scopes_disabled():
+                spaces = list(Space.objects.filter(id__in=options['space']))
+            if not spaces:
+                self.stdout.write(self.style.WARNING(_('No space found')))
+                return
+
+        if not options['schedule']:
+            self.cleanup(spaces, options)
+            return
+        if not settings.RETENTION_INTERVAL:
+            return
+        while True:
+            time.sleep(settings.RETENTION_INTERVAL * 3600)
+            try:
+                self.cleanup(spaces, options)
+            except Exception:
+                # the next cleanup is still run
+                traceback.print_exc()
+            finally:
+                # the connection is not kept open while sleeping
+                connection.close()
+
+    def cleanup(self, spaces, options):
+        counts = delete_old_history(spaces=spaces, batch_size=options['batch_size'], dry_run=options['dry_run'])
+        if counts is None:
+            self.stdout.write(self.style.WARNING(_('History is already being cleaned up by another process')))
+            return
+        for name, count in counts.items():
+            self.stdout.write(f'{name}: {count}')
+        self.stdout.write(self.style.SUCCESS(_('History cleanup complete.')))
@@ -5,7 +5,7 @@ from django_scopes import scopes_disabled
 from django.utils import translation
 from django.utils.translation import gettext_lazy as _
 
-from cookbook.managers import DICTIONARY
+from cookbook.managers import DICTIONARY, update_search_document
 from cookbook.models import Recipe, Step
 
 
@@ -25,6 +25,7 @@ class Command(BaseCommand):
                     desc_search_vector=SearchVector('description__unaccent', weight='B', config=language)
                 )
                 Step.objects.all().update(search_vector=SearchVector('instruction__unaccent', weight='B', config=language))
+                update_search_document()
 
                 self.stdout.write(self.style.SUCCESS(_('Recipe index rebuild complete.')))
         except Exception:
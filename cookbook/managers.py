@@ -1,10 +1,14 @@
+import re
+
+from django.conf import settings
 from django.contrib.postgres.aggregates import StringAgg
 from django.contrib.postgres.search import (
-    SearchQuery, SearchRank, SearchVector,
+    SearchQuery, SearchRank, SearchVector, SearchVectorField,
 )
-from django.db import models
-from django.db.models import Q
+from django.db import connection, models
+from django.db.models import Func, OuterRef, Q, Subquery, TextField, Value
 from django.utils import translation
+from django_scopes import scopes_disabled
 
 DICTIONARY = {
     # TODO find custom dictionaries - maybe from here https://www.postgresql.org/message-id/CAF4Au4x6X_wSXFwsQYE8q5o0aQZANrvYjZJ8uOnsiHDnOVPPEg%40mail.gmail.com
@@ -20,6 +24,145 @@ DICTIONARY = {
     'es': 'spanish',
 }
 
+# weight of each search field inside Recipe.search_vector, postgres only knows four weights
+SEARCH_DOCUMENT_WEIGHTS = {
+    'name': 'A',
+    'keywords__name': 'B',
+    'steps__ingredients__food__name': 'C',
+    'description': 'D',
+    'steps__instruction': 'D',
+}
+
+
+class SearchDocumentFilter(Func):
+    """
+    reduces a search document to the lexemes of the given weights, e.g. to only search names and keywords
+    """
+    function = 'ts_filter'
+
+    def __init__(self, expression, weights, **extra):
+        super().__init__(expression, Value('{%s}' % ','.join(sorted(weights)).lower()), output_field=SearchVectorField(), **extra)
+
+
+class Unaccent(Func):
+    """
+    immutable unaccent created by migration 0170, unlike the __unaccent lookup it can use the trigram indexes
+    """
+    function = 'cookbook_unaccent'
+    output_field = TextField()
+
+
+def set_similarity_threshold(threshold):
+    """
+    sets the similarity the trigram operator % (__trigram_similar) requires for the current transaction.
+    the setting does not outlive the transaction so it never leaks to other requests on a persistent connection,
+    queries using the operator have to be evaluated in the same transaction.atomic block
+    """
+    if connection.vendor != 'postgresql':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT set_config('pg_trgm.similarity_threshold', %s, true)", [str(threshold)])
+
+
+def recipe_search_document(language):
+    """
+    weighted search document of a recipe and its related steps, foods and keywords
+    related text is aggregated in correlated subqueries so the document can be written with a single UPDATE
+    """
+    from cookbook.models import Food, Keyword, Step
+
+    def related_text(queryset, recipe_field, text_field):
+        return Subquery(
+            queryset.filter(**{recipe_field: OuterRef('pk')}).order_by().values(recipe_field)
+            .annotate(text=StringAgg(text_field, delimiter=' ', distinct=True, output_field=TextField())).values('text')
+        )
+
+    weights = SEARCH_DOCUMENT_WEIGHTS
+    return (
+        SearchVector('name__unaccent', weight=weights['name'], config=language)
+        + SearchVector(related_text(Keyword.objects, 'recipe', 'name__unaccent'), weight=weights['keywords__name'], config=language)
+        + SearchVector(related_text(Food.objects, 'ingredient__step__recipe', 'name__unaccent'), weight=weights['steps__ingredients__food__name'], config=language)
+        + SearchVector('description__unaccent', weight=weights['description'], config=language)
+        + SearchVector(related_text(Step.objects, 'recipe', 'instruction__unaccent'), weight=weights['steps__instruction'], config=language)
+    )
+
+
+def update_search_document(**recipe_filter):
+    """
+    rebuilds the search document of all recipes matching the filter,
+    Recipe.search_vector on postgres and the full text search table on sqlite
+    """
+    from cookbook.models import Recipe
+
+    with scopes_disabled():
+        recipes = Recipe.objects.filter(**recipe_filter)
+        if settings.DATABASES['default']['ENGINE'] in ['django.db.backends.postgresql_psycopg2', 'django.db.backends.postgresql']:
+            language = DICTIONARY.get(translation.get_language(), 'simple')
+            recipes.update(search_vector=recipe_search_document(language))
+        elif sqlite_fts_available():
+            update_fts_document(recipes)
+
+
+# sqlite full text search table (FTS5), the rowid is the id of the recipe
+FTS_TABLE = 'cookbook_recipe_fts'
+FTS_COLUMNS = {
+    'name': 'name',
+    'description': 'description',
+    'steps__instruction': 'instructions',
+    'steps__ingredients__food__name': 'foods',
+    'keywords__name': 'keywords',
+}
+# bm25 weight of each column in table order, follows the weights of the postgres search document
+FTS_WEIGHTS = (10.0, 1.0, 1.0, 2.0, 4.0)
+
+
+_sqlite_fts_table = False
+
+
+def sqlite_fts_available():
+    # the table is not created if sqlite is compiled without FTS5.
+    # only an existing table is remembered, migration 0171 may create it after the first check
+    global _sqlite_fts_table
+    if not _sqlite_fts_table:
+        _sqlite_fts_table = settings.DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3' and FTS_TABLE in connection.introspection.table_names()
+    return _sqlite_fts_table
+
+
+def update_fts_document(recipes):
+    sql, params = recipes.values('id').query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid IN ({sql})', params)
+        cursor.execute(f"""
+            INSERT INTO {FTS_TABLE} (rowid, name, description, instructions, foods, keywords)
+            SELECT r.id, r.name, coalesce(r.description, ''),
+                (SELECT group_concat(s.instruction, ' ') FROM cookbook_step s
+                    JOIN cookbook_recipe_steps rs ON rs.step_id = s.id WHERE rs.recipe_id = r.id),
+                (SELECT group_concat(DISTINCT f.name) FROM cookbook_food f
+                    JOIN cookbook_ingredient i ON i.food_id = f.id
+                    JOIN cookbook_step_ingredients si ON si.ingredient_id = i.id
+                    JOIN cookbook_recipe_steps rs ON rs.step_id = si.step_id WHERE rs.recipe_id = r.id),
+                (SELECT group_concat(k.name, ' ') FROM cookbook_keyword k
+                    JOIN cookbook_recipe_keywords rk ON rk.keyword_id = k.id WHERE rk.recipe_id = r.id)
+            FROM cookbook_recipe r WHERE r.id IN ({sql})
+        """, params)
+
+
+def remove_fts_document(recipe_id):
+    if sqlite_fts_available():
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [recipe_id])
+
+
+def fts_query(string, fields):
+    """
+    FTS5 query matching all words of the search string as prefixes in the columns of the given search fields
+    """
+    terms = re.findall(r'\w+', string)
+    columns = [FTS_COLUMNS[f] for f in fields if f in FTS_COLUMNS]
+    if not terms or not columns:
+        return None
+    return '{%s} : %s' % (' '.join(columns), ' '.join(f'"{t}"*' for t in terms))
+
 
 # TODO add schedule index rebuild
 class RecipeSearchManager(models.Manager):
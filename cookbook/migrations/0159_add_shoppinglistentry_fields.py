@@ -6,10 +6,12 @@ from django.conf import settings
 from django.db import migrations, models
 from django_scopes import scopes_disabled
 
-from cookbook.models import PermissionModelMixin, ShoppingListEntry
+from cookbook.models import PermissionModelMixin
 
 
 def copy_values_to_sle(apps, schema_editor):
+    # the historical model, the current one has fields that do not exist yet at this point
+    ShoppingListEntry = apps.get_model('cookbook', 'ShoppingListEntry')
     with scopes_disabled():
         entries = ShoppingListEntry.objects.all()
         for entry in entries:
@@ -10,10 +10,12 @@ from django.utils import timezone
 from django.utils.timezone import utc
 from django_scopes import scopes_disabled
 
-from cookbook.models import FoodInheritField, ShoppingListEntry
+from cookbook.models import FoodInheritField
 
 
 def delete_orphaned_sle(apps, schema_editor):
+    # the historical model, the current one has fields that do not exist yet at this point
+    ShoppingListEntry = apps.get_model('cookbook', 'ShoppingListEntry')
     with scopes_disabled():
         # shopping list entry is orphaned - delete it
         ShoppingListEntry.objects.filter(shoppinglist=None).delete()
@@ -32,6 +34,7 @@ def set_completed_at(apps, schema_editor):
     today_start = timezone.now().replace(hour=0, minute=0, second=0)
     # arbitrary - keeping all of the closed shopping list items out of the 'recent' view
     month_ago = today_start - timedelta(days=30)
+    ShoppingListEntry = apps.get_model('cookbook', 'ShoppingListEntry')
     with scopes_disabled():
         ShoppingListEntry.objects.filter(checked=True).update(completed_at=month_ago)
 
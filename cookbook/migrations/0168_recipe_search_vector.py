@@ -0,0 +1,56 @@
+from django.conf import settings
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector, SearchVectorField
+from django.db import migrations
+from django.db.models import OuterRef, Subquery, TextField
+from django.utils import translation
+
+from cookbook.managers import DICTIONARY
+
+
+def set_search_document(apps, schema_editor):
+    if settings.DATABASES['default']['ENGINE'] not in ['django.db.backends.postgresql_psycopg2', 'django.db.backends.postgresql']:
+        return
+    # the historical models and the weights of this migration, the live search document may change later
+    Recipe = apps.get_model('cookbook', 'Recipe')
+    Keyword = apps.get_model('cookbook', 'Keyword')
+    Food = apps.get_model('cookbook', 'Food')
+    Step = apps.get_model('cookbook', 'Step')
+    language = DICTIONARY.get(translation.get_language(), 'simple')
+
+    def related_text(queryset, recipe_field, text_field):
+        return Subquery(
+            queryset.filter(**{recipe_field: OuterRef('pk')}).order_by().values(recipe_field)
+            .annotate(text=StringAgg(text_field, delimiter=' ', distinct=True, output_field=TextField())).values('text')
+        )
+
+    Recipe.objects.update(search_vector=(
+        SearchVector('name__unaccent', weight='A', config=language)
+        + SearchVector(related_text(Keyword.objects, 'recipe', 'name__unaccent'), weight='B', config=language)
+        + SearchVector(related_text(Food.objects, 'ingredient__step__recipe', 'name__unaccent'), weight='C', config=language)
+        + SearchVector('description__unaccent', weight='D', config=language)
+        + SearchVector(related_text(Step.objects, 'recipe', 'instruction__unaccent'), weight='D', config=language)
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cookbook', '0167_userpreference_left_handed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='search_vector',
+            field=SearchVectorField(null=True),
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=GinIndex(fields=['search_vector'], name='cookbook_re_search__404e46_gin'),
+        ),
+        migrations.RunPython(
+            set_search_document
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 3.2.11 on 2026-10-18 12:15
+
+import cookbook.models
+from django.db import migrations, models
+from django.db.models.functions import Random
+
+
+def randomize_keys(apps, schema_editor):
+    # the default is only evaluated once for existing rows
+    for model in ['Food', 'Keyword', 'Recipe']:
+        apps.get_model('cookbook', model).objects.update(random_key=Random())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cookbook', '0168_recipe_search_vector'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='food',
+            name='random_key',
+            field=models.FloatField(default=cookbook.models.default_random_key),
+        ),
+        migrations.AddField(
+            model_name='keyword',
+            name='random_key',
+            field=models.FloatField(default=cookbook.models.default_random_key),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='random_key',
+            field=models.FloatField(default=cookbook.models.default_random_key),
+        ),
+        migrations.RunPython(
+            randomize_keys
+        ),
+        migrations.AddIndex(
+            model_name='food',
+            index=models.Index(fields=['space', 'random_key'], name='cookbook_fo_space_i_d2e36f_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='keyword',
+            index=models.Index(fields=['space', 'random_key'], name='cookbook_ke_space_i_d20129_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['space', 'random_key'], name='cookbook_re_space_i_706636_idx'),
+        ),
+    ]
@@ -0,0 +1,58 @@
+from django.conf import settings
+from django.db import migrations
+
+# table, column and expression of all columns searched with trigram similarity
+TRIGRAM_INDEXES = [
+    ('cookbook_recipe', 'name', 'name'),
+    ('cookbook_recipe', 'name_unaccent', 'cookbook_unaccent(name)'),
+    ('cookbook_recipe', 'description', 'description'),
+    ('cookbook_recipe', 'description_unaccent', 'cookbook_unaccent(description)'),
+    ('cookbook_step', 'instruction', 'instruction'),
+    ('cookbook_step', 'instruction_unaccent', 'cookbook_unaccent(instruction)'),
+    ('cookbook_food', 'name', 'name'),
+    ('cookbook_food', 'name_unaccent', 'cookbook_unaccent(name)'),
+    ('cookbook_food', 'name_upper', 'upper(name)'),
+    ('cookbook_keyword', 'name', 'name'),
+    ('cookbook_keyword', 'name_unaccent', 'cookbook_unaccent(name)'),
+    ('cookbook_keyword', 'name_upper', 'upper(name)'),
+    ('cookbook_unit', 'name', 'name'),
+    ('cookbook_unit', 'name_upper', 'upper(name)'),
+]
+
+
+def create_trigram_indexes(apps, schema_editor):
+    if settings.DATABASES['default']['ENGINE'] not in ['django.db.backends.postgresql_psycopg2', 'django.db.backends.postgresql']:
+        return
+    # unaccent() is not immutable and can't be used in an index, the wrapper fixes the dictionary which makes it immutable
+    schema_editor.execute(
+        "CREATE OR REPLACE FUNCTION cookbook_unaccent(text) RETURNS text "
+        "AS $$ SELECT unaccent('unaccent'::regdictionary, $1) $$ LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT"
+    )
+    # the index operator class is part of pg_trgm, skip the indexes if it is missing
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_opclass WHERE opcname = 'gin_trgm_ops'")
+        if not cursor.fetchone():
+            return
+    for table, name, expression in TRIGRAM_INDEXES:
+        schema_editor.execute(f"CREATE INDEX IF NOT EXISTS {table}_{name}_trgm ON {table} USING gin ({expression} gin_trgm_ops)")
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    if settings.DATABASES['default']['ENGINE'] not in ['django.db.backends.postgresql_psycopg2', 'django.db.backends.postgresql']:
+        return
+    for table, name, expression in TRIGRAM_INDEXES:
+        schema_editor.execute(f"DROP INDEX IF EXISTS {table}_{name}_trgm")
+    schema_editor.execute("DROP FUNCTION IF EXISTS cookbook_unaccent(text)")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cookbook', '0169_random_key'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            create_trigram_indexes, drop_trigram_indexes
+        ),
+    ]
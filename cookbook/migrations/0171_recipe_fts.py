@@ -0,0 +1,51 @@
+from django.conf import settings
+from django.db import migrations
+from django.db.utils import OperationalError
+
+# the table of this migration, the live search helpers may change later
+FTS_TABLE = 'cookbook_recipe_fts'
+
+
+def create_fts_table(apps, schema_editor):
+    if settings.DATABASES['default']['ENGINE'] != 'django.db.backends.sqlite3':
+        return
+    try:
+        schema_editor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} "
+            f"USING fts5(name, description, instructions, foods, keywords, tokenize='unicode61 remove_diacritics 2')"
+        )
+    except OperationalError:
+        # sqlite compiled without FTS5, search falls back to the text filters
+        return
+    schema_editor.execute(f"""
+        INSERT INTO {FTS_TABLE} (rowid, name, description, instructions, foods, keywords)
+        SELECT r.id, r.name, coalesce(r.description, ''),
+            (SELECT group_concat(s.instruction, ' ') FROM cookbook_step s
+                JOIN cookbook_recipe_steps rs ON rs.step_id = s.id WHERE rs.recipe_id = r.id),
+            (SELECT group_concat(DISTINCT f.name) FROM cookbook_food f
+                JOIN cookbook_ingredient i ON i.food_id = f.id
+                JOIN cookbook_step_ingredients si ON si.ingredient_id = i.id
+                JOIN cookbook_recipe_steps rs ON rs.step_id = si.step_id WHERE rs.recipe_id = r.id),
+            (SELECT group_concat(k.name, ' ') FROM cookbook_keyword k
+                JOIN cookbook_recipe_keywords rk ON rk.keyword_id = k.id WHERE rk.recipe_id = r.id)
+        FROM cookbook_recipe r
+    """)
+
+
+def drop_fts_table(apps, schema_editor):
+    if settings.DATABASES['default']['ENGINE'] != 'django.db.backends.sqlite3':
+        return
+    schema_editor.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cookbook', '0170_trigram_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            create_fts_table, drop_fts_table
+        ),
+    ]
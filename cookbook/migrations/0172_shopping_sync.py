@@ -0,0 +1,49 @@
+# Generated by Django 3.2.11 on 2026-10-18 13:01
+
+import cookbook.models
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('cookbook', '0171_recipe_fts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShoppingListEntryTombstone',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('entry_id', models.IntegerField()),
+                ('deleted_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            bases=(models.Model, cookbook.models.PermissionModelMixin),
+        ),
+        migrations.AddField(
+            model_name='shoppinglistentry',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name='shoppinglistentry',
+            index=models.Index(fields=['space', 'updated_at'], name='cookbook_sh_space_i_ce8a1b_idx'),
+        ),
+        migrations.AddField(
+            model_name='shoppinglistentrytombstone',
+            name='created_by',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='shoppinglistentrytombstone',
+            name='space',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to='cookbook.space'),
+        ),
+        migrations.AddIndex(
+            model_name='shoppinglistentrytombstone',
+            index=models.Index(fields=['space', 'deleted_at'], name='cookbook_sh_space_i_6069b8_idx'),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 3.2.11 on 2026-10-18 14:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cookbook', '0172_shopping_sync'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='space',
+            name='cook_log_retention_days',
+            field=models.IntegerField(blank=True, help_text='Days the cook log is kept.', null=True),
+        ),
+        migrations.AddField(
+            model_name='space',
+            name='import_log_retention_days',
+            field=models.IntegerField(blank=True, help_text='Days the import log is kept.', null=True),
+        ),
+        migrations.AddField(
+            model_name='space',
+            name='shopping_retention_days',
+            field=models.IntegerField(blank=True, help_text='Days completed shopping list entries are kept.', null=True),
+        ),
+        migrations.AddField(
+            model_name='space',
+            name='sync_log_retention_days',
+            field=models.IntegerField(blank=True, help_text='Days the storage sync log is kept.', null=True),
+        ),
+        migrations.AddField(
+            model_name='space',
+            name='view_log_retention_days',
+            field=models.IntegerField(blank=True, help_text='Days the recipe view history is kept.', null=True),
+        ),
+        migrations.AddIndex(
+            model_name='importlog',
+            index=models.Index(fields=['space', 'created_at'], name='cookbook_im_space_i_96ed70_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='shoppinglistentry',
+            index=models.Index(condition=models.Q(('checked', False)), fields=['space', 'created_by'], name='shopping_entry_unchecked_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='shoppinglistentry',
+            index=models.Index(condition=models.Q(('checked', True)), fields=['space', 'completed_at'], name='shopping_entry_checked_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='synclog',
+            index=models.Index(fields=['created_at'], name='cookbook_sy_created_4f42cf_idx'),
+        ),
+    ]
@@ -4,7 +4,7 @@ from decimal import Decimal
 from gettext import gettext as _
 
 from django.contrib.auth.models import User
-from django.db.models import Avg, QuerySet, Sum
+from django.db.models import Avg, Manager, QuerySet, Sum
 from django.urls import reverse
 from django.utils import timezone
 from drf_writable_nested import UniqueFieldsMixin, WritableNestedModelSerializer
@@ -13,6 +13,7 @@ from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.fields import empty
 
 from cookbook.helper.HelperFunctions import str2bool
+from cookbook.helper.permission_helper import is_object_owner
 from cookbook.helper.shopping_helper import list_from_recipe
 from cookbook.models import (Automation, BookmarkletImport, Comment, CookLog, Food,
                              FoodInheritField, ImportLog, Ingredient, Keyword, MealPlan, MealType,
@@ -87,12 +88,13 @@ class CustomOnHandField(serializers.Field):
         return instance
 
     def to_representation(self, obj):
-        shared_users = None
-        if request := self.context.get('request', None):
-            shared_users = getattr(request, '_shared_users', None)
-        if shared_users is None:
-            shared_users = [x.id for x in list(self.context['request'].user.get_shopping_share())] + [self.context['request'].user.id]
-        return obj.onhand_users.filter(id__in=shared_users).exists()
+        # food lists annotate the status, foods of ingredients and shopping entries prefetch the relevant users
+        if (onhand := getattr(obj, 'onhand_status', None)) is not None:
+            return onhand
+        if (onhand_users := getattr(obj, 'shared_onhand_users', None)) is not None:
+            return len(onhand_users) > 0
+        user = self.context['request'].user
+        return obj.onhand_users.filter(id__in=[*user.get_shopping_share_ids(), user.id]).exists()
 
     def to_internal_value(self, data):
         return data
@@ -106,12 +108,26 @@ class SpaceFilterSerializer(serializers.ListSerializer):
         if (type(data) == QuerySet and data.query.is_sliced):
             # if query is sliced it came from api request not nested serializer
             return super().to_representation(data)
+        prefetched = getattr(getattr(data, 'instance', None), '_prefetched_objects_cache', {})
+        if isinstance(data, Manager) and getattr(data, 'prefetch_cache_name', None) in prefetched:
+            # prefetched objects are filtered in python, filtering the manager would query every object separately
+            space = self.context['request'].space
+            return super().to_representation([x for x in data.all() if self.get_space_id(x) == space.id])
         if self.child.Meta.model == User:
             data = data.filter(userpreference__space=self.context['request'].space)
         else:
             data = data.filter(**{'__'.join(data.model.get_space_key()): self.context['request'].space})
         return super().to_representation(data)
 
+    def get_space_id(self, obj):
+        if self.child.Meta.model == User:
+            # prefetched users are annotated with the space of their preference, reading the preference opens a savepoint
+            return getattr(obj, 'space_id', None) or getattr(getattr(obj, 'userpreference', None), 'space_id', None)
+        *path, field = obj.get_space_key()
+        for attr in path:
+            obj = getattr(obj, attr)
+        return getattr(obj, f'{field}_id')
+
 
 class SpacedModelSerializer(serializers.ModelSerializer):
     def create(self, validated_data):
@@ -425,6 +441,8 @@ class FoodSerializer(UniqueFieldsMixin, WritableNestedModelSerializer, ExtendedR
                 validated_data['onhand_users'] = list(self.instance.onhand_users.all()) + shared_users
             else:
                 validated_data['onhand_users'] = list(set(self.instance.onhand_users.all()) - set(shared_users))
+            # the status annotated when the food was loaded is outdated
+            instance.__dict__.pop('onhand_status', None)
         return super(FoodSerializer, self).update(instance, validated_data)
 
     class Meta:
@@ -515,6 +533,9 @@ class NutritionInformationSerializer(serializers.ModelSerializer):
 
 class RecipeBaseSerializer(WritableNestedModelSerializer):
     def get_recipe_rating(self, obj):
+        # annotated by the recipe search
+        if hasattr(obj, 'recipe_rating'):
+            return obj.recipe_rating or 0
         try:
             rating = obj.cooklog_set.filter(created_by=self.context['request'].user, rating__gt=0).aggregate(
                 Avg('rating'))
@@ -525,6 +546,8 @@ class RecipeBaseSerializer(WritableNestedModelSerializer):
         return 0
 
     def get_recipe_last_cooked(self, obj):
+        if hasattr(obj, 'recipe_last_cooked'):
+            return obj.recipe_last_cooked
         try:
             last = obj.cooklog_set.filter(created_by=self.context['request'].user).order_by('created_at').last()
             if last:
@@ -630,7 +653,7 @@ class RecipeBookEntrySerializer(serializers.ModelSerializer):
     def create(self, validated_data):
         book = validated_data['book']
         recipe = validated_data['recipe']
-        if not book.get_owner() == self.context['request'].user:
+        if not is_object_owner(self.context['request'].user, book):
             raise NotFound(detail=None, code=None)
         obj, created = RecipeBookEntry.objects.get_or_create(book=book, recipe=recipe)
         return obj
@@ -654,6 +677,9 @@ class MealPlanSerializer(SpacedModelSerializer, WritableNestedModelSerializer):
         return markdown(obj.note)
 
     def in_shopping(self, obj):
+        # annotated by the meal plan list
+        if hasattr(obj, 'in_shopping'):
+            return obj.in_shopping
         return ShoppingListRecipe.objects.filter(mealplan=obj.id).exists()
 
     def create(self, validated_data):
@@ -770,6 +796,20 @@ class ShoppingListEntrySerializer(WritableNestedModelSerializer):
         read_only_fields = ('id', 'created_by', 'created_at',)
 
 
+class ShoppingListEntryAggregateSerializer(serializers.Serializer):
+    food = serializers.IntegerField(read_only=True)
+    food_name = serializers.CharField(source='food__name', read_only=True)
+    unit = serializers.IntegerField(read_only=True)
+    unit_name = serializers.CharField(source='unit__name', read_only=True)
+    supermarket_category = serializers.IntegerField(source='food__supermarket_category', read_only=True)
+    supermarket_category_name = serializers.CharField(source='food__supermarket_category__name', read_only=True)
+    amount = CustomDecimalField(read_only=True)
+    checked = serializers.BooleanField(read_only=True)
+    delayed = serializers.BooleanField(read_only=True)
+    entries = serializers.ListField(child=serializers.IntegerField(), read_only=True)
+    recipes = serializers.ListField(child=serializers.CharField(), read_only=True)
+
+
 # TODO deprecate
 class ShoppingListEntryCheckedSerializer(serializers.ModelSerializer):
     class Meta:
@@ -979,3 +1019,28 @@ class FoodShoppingUpdateSerializer(serializers.ModelSerializer):
     class Meta:
         model = Recipe
         fields = ['id', 'amount', 'unit', 'delete', ]
+
+
+class ShoppingListEntryBulkSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.IntegerField(), required=False, help_text=_("IDs of the shopping list entries to change"))
+    food = serializers.IntegerField(required=False, help_text=_("ID of a food, changes all of its entries"))
+    checked = serializers.BooleanField(required=False)
+    delay_until = serializers.DateTimeField(required=False, allow_null=True)
+
+    def validate(self, data):
+        if not data.get('ids') and data.get('food') is None:
+            raise ValidationError(_('Either ids or food is required.'))
+        if 'checked' not in data and 'delay_until' not in data:
+            raise ValidationError(_('Nothing to update, provide checked or delay_until.'))
+        return data
+
+
+class MealPlanShoppingSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.IntegerField(), required=False, help_text=_("IDs of the meal plans to add"))
+    from_date = serializers.DateField(required=False, help_text=_("Add the meal plans from (inclusive) this date"))
+    to_date = serializers.DateField(required=False, help_text=_("Add the meal plans up to (inclusive) this date"))
+
+    def validate(self, data):
+        if not data.get('ids') and ('from_date' not in data or 'to_date' not in data):
+            raise ValidationError(_('Either ids or from_date and to_date are required.'))
+        return data
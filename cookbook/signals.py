@@ -3,14 +3,20 @@ from functools import wraps
 
 from django.conf import settings
 from django.contrib.postgres.search import SearchVector
-from django.db.models.signals import post_save
+from django.core.cache import caches
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
 from django.dispatch import receiver
 from django.utils import translation
+from django_scopes import scopes_disabled
 
-from cookbook.helper.shopping_helper import list_from_recipe
-from cookbook.managers import DICTIONARY
-from cookbook.models import (Food, FoodInheritField, Ingredient, MealPlan, Recipe,
-                             ShoppingListEntry, Step)
+from cookbook.helper.cache_helper import bump_space_data_version, touch_meal_plans
+from cookbook.helper.shopping_helper import (add_mealplan_after_commit, list_from_recipe,
+                                             supermarket_order_cache_key)
+from cookbook.managers import DICTIONARY, remove_fts_document, update_search_document
+from cookbook.models import (CookLog, Food, FoodInheritField, Ingredient, Keyword, MealPlan,
+                             MealType, Recipe, RecipeBookEntry, ShoppingListEntry,
+                             ShoppingListEntryTombstone, Step, SupermarketCategoryRelation,
+                             UserPreference, invalidate_shopping_share)
 
 SQLITE = True
 if settings.DATABASES['default']['ENGINE'] in ['django.db.backends.postgresql_psycopg2',
@@ -34,30 +40,183 @@ def skip_signal(signal_func):
 @receiver(post_save, sender=Recipe)
 @skip_signal
 def update_recipe_search_vector(sender, instance=None, created=False, **kwargs):
-    if SQLITE:
-        return
-    language = DICTIONARY.get(translation.get_language(), 'simple')
-    instance.name_search_vector = SearchVector('name__unaccent', weight='A', config=language)
-    instance.desc_search_vector = SearchVector('description__unaccent', weight='C', config=language)
-    try:
-        instance.skip_signal = True
-        instance.save()
-    finally:
-        del instance.skip_signal
+    if not SQLITE:
+        language = DICTIONARY.get(translation.get_language(), 'simple')
+        instance.name_search_vector = SearchVector('name__unaccent', weight='A', config=language)
+        instance.desc_search_vector = SearchVector('description__unaccent', weight='C', config=language)
+        try:
+            instance.skip_signal = True
+            instance.save()
+        finally:
+            del instance.skip_signal
+    update_search_document(pk=instance.pk)
 
 
 @receiver(post_save, sender=Step)
 @skip_signal
 def update_step_search_vector(sender, instance=None, created=False, **kwargs):
-    if SQLITE:
+    if not SQLITE:
+        language = DICTIONARY.get(translation.get_language(), 'simple')
+        instance.search_vector = SearchVector('instruction__unaccent', weight='B', config=language)
+        try:
+            instance.skip_signal = True
+            instance.save()
+        finally:
+            del instance.skip_signal
+    if not created:
+        update_search_document(steps=instance)
+
+
+# recipes whose search document contains text of the instance
+SEARCH_DOCUMENT_RELATIONS = {
+    Step: 'steps',
+    Ingredient: 'steps__ingredients',
+    Food: 'steps__ingredients__food',
+    Keyword: 'keywords',
+}
+
+
+# the field of the instance whose value is part of the search document, ingredients add the name of their food
+SEARCH_DOCUMENT_FIELDS = {
+    Ingredient: 'food',
+    Food: 'name',
+    Keyword: 'name',
+}
+
+
+@receiver(pre_save, sender=Ingredient)
+@receiver(pre_save, sender=Food)
+@receiver(pre_save, sender=Keyword)
+def check_search_document_text(sender, instance=None, update_fields=None, **kwargs):
+    # new objects are not part of a recipe yet, they get added through m2m_changed
+    instance.search_document_changed = False
+    field = sender._meta.get_field(SEARCH_DOCUMENT_FIELDS[sender])
+    if instance.pk is None or (update_fields is not None and not {field.name, field.attname} & set(update_fields)):
         return
-    language = DICTIONARY.get(translation.get_language(), 'simple')
-    instance.search_vector = SearchVector('instruction__unaccent', weight='B', config=language)
-    try:
-        instance.skip_signal = True
-        instance.save()
-    finally:
-        del instance.skip_signal
+    old = list(sender._base_manager.filter(pk=instance.pk).values_list(field.attname, flat=True)[:1])
+    instance.search_document_changed = bool(old) and old[0] != getattr(instance, field.attname)
+
+
+@receiver(post_save, sender=Ingredient)
+@receiver(post_save, sender=Food)
+@receiver(post_save, sender=Keyword)
+def update_related_search_document(sender, instance=None, created=False, **kwargs):
+    # saves that keep the indexed text, like the amount of an ingredient or the category of a food, keep the documents
+    if created or not getattr(instance, 'search_document_changed', False):
+        return
+    update_search_document(**{SEARCH_DOCUMENT_RELATIONS[sender]: instance})
+
+
+@receiver(m2m_changed, sender=Recipe.keywords.through)
+@receiver(m2m_changed, sender=Recipe.steps.through)
+@receiver(m2m_changed, sender=Step.ingredients.through)
+def update_search_document_relations(sender, instance=None, action=None, reverse=False, pk_set=None, **kwargs):
+    if action not in ['post_add', 'post_remove', 'post_clear']:
+        return
+    if sender == Step.ingredients.through:
+        if reverse:
+            if pk_set:
+                update_search_document(steps__in=pk_set)
+        else:
+            update_search_document(steps=instance)
+    elif reverse:
+        if pk_set:
+            update_search_document(pk__in=pk_set)
+    else:
+        update_search_document(pk=instance.pk)
+
+
+@receiver(pre_delete, sender=Step)
+@receiver(pre_delete, sender=Ingredient)
+@receiver(pre_delete, sender=Keyword)
+def collect_search_document_recipes(sender, instance=None, **kwargs):
+    # relations are gone once the instance is deleted, remember the recipes that need a new document
+    with scopes_disabled():
+        instance.search_document_recipes = list(Recipe.objects.filter(**{SEARCH_DOCUMENT_RELATIONS[sender]: instance}).values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Step)
+@receiver(post_delete, sender=Ingredient)
+@receiver(post_delete, sender=Keyword)
+def update_deleted_search_document(sender, instance=None, **kwargs):
+    recipes = getattr(instance, 'search_document_recipes', None)
+    if recipes:
+        update_search_document(pk__in=recipes)
+
+
+@receiver(post_delete, sender=Recipe)
+def remove_deleted_search_document(sender, instance=None, **kwargs):
+    # the fts table has no foreign key to the recipe, postgres keeps the document on the row itself
+    remove_fts_document(instance.pk)
+
+
+@receiver(post_save, sender=Recipe)
+@receiver(post_save, sender=Step)
+@receiver(post_save, sender=Ingredient)
+@receiver(post_save, sender=Keyword)
+@receiver(post_save, sender=Food)
+@receiver(post_save, sender=CookLog)
+@receiver(post_save, sender=RecipeBookEntry)
+@receiver(post_delete, sender=Recipe)
+@receiver(post_delete, sender=Step)
+@receiver(post_delete, sender=Ingredient)
+@receiver(post_delete, sender=Keyword)
+@receiver(post_delete, sender=Food)
+@receiver(post_delete, sender=CookLog)
+@receiver(post_delete, sender=RecipeBookEntry)
+def update_space_data_version(sender, instance=None, **kwargs):
+    # cached search results of the space are computed from an older version of the data
+    bump_space_data_version(getattr(instance, 'space_id', None) or instance.get_space().pk)
+
+
+@receiver(m2m_changed, sender=Recipe.keywords.through)
+@receiver(m2m_changed, sender=Recipe.steps.through)
+@receiver(m2m_changed, sender=Step.ingredients.through)
+def update_space_data_version_relations(sender, instance=None, action=None, **kwargs):
+    if action in ['post_add', 'post_remove', 'post_clear']:
+        bump_space_data_version(instance.space_id)
+
+
+@receiver(post_save, sender=MealPlan)
+@receiver(post_save, sender=MealType)
+@receiver(post_save, sender=Recipe)
+@receiver(post_delete, sender=MealPlan)
+@receiver(post_delete, sender=MealType)
+@receiver(post_delete, sender=Recipe)
+def update_meal_plans_changed(sender, instance=None, **kwargs):
+    # meal plan feeds show the meal type and recipe names
+    touch_meal_plans(instance.space_id)
+
+
+@receiver(m2m_changed, sender=MealPlan.shared.through)
+def update_meal_plans_changed_shared(sender, instance=None, action=None, reverse=False, **kwargs):
+    if action in ['post_add', 'post_remove', 'post_clear']:
+        touch_meal_plans(instance.userpreference.space_id if reverse else instance.space_id)
+
+
+@receiver(m2m_changed, sender=UserPreference.shopping_share.through)
+def invalidate_shopping_share_cache(sender, instance=None, action=None, reverse=False, pk_set=None, **kwargs):
+    # the cached share set of a user lists the users sharing with them, so the users added to or removed from
+    # a preference are the ones whose cache is stale
+    if reverse:
+        if action in ['post_add', 'post_remove', 'post_clear']:
+            invalidate_shopping_share([instance.id])
+    elif action == 'pre_clear':
+        invalidate_shopping_share(instance.shopping_share.values_list('id', flat=True))
+    elif action in ['post_add', 'post_remove'] and pk_set:
+        invalidate_shopping_share(pk_set)
+
+
+@receiver(pre_delete, sender=UserPreference)
+def invalidate_deleted_shopping_share(sender, instance=None, **kwargs):
+    # the share rows are deleted without m2m signals, also when the preference is deleted together with its user
+    invalidate_shopping_share([instance.user_id, *instance.shopping_share.values_list('id', flat=True)])
+
+
+@receiver(post_save, sender=SupermarketCategoryRelation)
+@receiver(post_delete, sender=SupermarketCategoryRelation)
+def invalidate_supermarket_order(sender, instance=None, **kwargs):
+    caches['default'].delete(supermarket_order_cache_key(instance.supermarket_id))
 
 
 @receiver(post_save, sender=Food)
@@ -102,6 +261,12 @@ def update_food_inheritance(sender, instance=None, created=False, **kwargs):
         child.save()
 
 
+@receiver(post_delete, sender=ShoppingListEntry)
+def create_shopping_tombstone(sender, instance=None, **kwargs):
+    # clients syncing with a token only receive changed entries, deletions have to be recorded
+    ShoppingListEntryTombstone.objects.create(entry_id=instance.id, created_by_id=instance.created_by_id, space_id=instance.space_id)
+
+
 @receiver(post_save, sender=MealPlan)
 def auto_add_shopping(sender, instance=None, created=False, weak=False, **kwargs):
     user = instance.get_owner()
@@ -113,11 +278,5 @@ def auto_add_shopping(sender, instance=None, created=False, weak=False, **kwargs
             if instance.servings != x.servings:
                 list_recipe = list_from_recipe(list_recipe=x, servings=instance.servings, space=instance.space)
     elif created:
-        # if creating a mealplan - perform shopping list activities
-        kwargs = {
-            'mealplan': instance,
-            'space': instance.space,
-            'created_by': user,
-            'servings': instance.servings
-        }
-        list_recipe = list_from_recipe(**kwargs)
+        # if creating a mealplan - perform shopping list activities once it is committed
+        add_mealplan_after_commit(instance)
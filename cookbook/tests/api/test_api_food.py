@@ -1,7 +1,10 @@
 import json
 
 import pytest
+from django.conf import settings
 from django.contrib import auth
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django_scopes import scope, scopes_disabled
 from pytest_factoryboy import LazyFixture, register
@@ -75,6 +78,20 @@ def obj_tree_1(request, space_1):
     return Food.objects.get(id=objs[1].id)  # whenever you move/merge a tree it's safest to re-get the object
 
 
+@pytest.mark.skipif(not settings.DATABASES['default']['ENGINE'].startswith('django.db.backends.postgresql'), reason='trigram search needs postgres')
+def test_list_fuzzy(u1_s1, space_1):
+    with scopes_disabled():
+        user = auth.get_user(u1_s1)
+        user.searchpreference.lookup = True
+        user.searchpreference.save()
+        for name in ['tomato', 'cherry tomato', 'cucumber']:
+            Food.objects.create(name=name, space=space_1)
+
+    # foods that are not similar to the query are left out, the others are sorted by similarity
+    response = json.loads(u1_s1.get(f'{reverse(LIST_URL)}?query=tomato').content)
+    assert [x['name'] for x in response['results']] == ['tomato', 'cherry tomato']
+
+
 @pytest.mark.parametrize("arg", [
     ['a_u', 403],
     ['g1_s1', 403],
@@ -535,7 +552,7 @@ def test_onhand(obj_1, u1_s1, u2_s1):
     assert json.loads(u1_s1.get(reverse(DETAIL_URL, args={obj_1.id})).content)['food_onhand'] == False
     assert json.loads(u2_s1.get(reverse(DETAIL_URL, args={obj_1.id})).content)['food_onhand'] == False
 
-    u1_s1.patch(
+    r = u1_s1.patch(
         reverse(
             DETAIL_URL,
             args={obj_1.id}
@@ -543,6 +560,7 @@ def test_onhand(obj_1, u1_s1, u2_s1):
         {'food_onhand': True},
         content_type='application/json'
     )
+    assert json.loads(r.content)['food_onhand'] == True
     assert json.loads(u1_s1.get(reverse(DETAIL_URL, args={obj_1.id})).content)['food_onhand'] == True
     assert json.loads(u2_s1.get(reverse(DETAIL_URL, args={obj_1.id})).content)['food_onhand'] == False
 
@@ -550,3 +568,24 @@ def test_onhand(obj_1, u1_s1, u2_s1):
     user2 = auth.get_user(u2_s1)
     user1.userpreference.shopping_share.add(user2)
     assert json.loads(u2_s1.get(reverse(DETAIL_URL, args={obj_1.id})).content)['food_onhand'] == True
+
+
+def test_onhand_list(space_1, u1_s1, u2_s1):
+    user1 = auth.get_user(u1_s1)
+    user2 = auth.get_user(u2_s1)
+    with scopes_disabled():
+        foods = FoodFactory.create_batch(6, space=space_1)
+        foods[0].onhand_users.add(user1)
+        foods[1].onhand_users.add(user2)
+    user2.userpreference.shopping_share.add(user1)
+
+    # the on hand status is annotated, no query per food
+    u1_s1.get(reverse(LIST_URL))
+    with CaptureQueriesContext(connection) as context:
+        r = json.loads(u1_s1.get(reverse(LIST_URL)).content)
+    assert {x['id']: x['food_onhand'] for x in r['results']} == {f.id: f.id in [foods[0].id, foods[1].id] for f in foods}
+    with scopes_disabled():
+        FoodFactory.create_batch(4, space=space_1)
+    with CaptureQueriesContext(connection) as more_foods:
+        u1_s1.get(reverse(LIST_URL))
+    assert len(more_foods.captured_queries) == len(context.captured_queries)
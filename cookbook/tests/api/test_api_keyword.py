@@ -108,6 +108,12 @@ def test_list_filter(obj_1, obj_2, u1_s1):
     response = json.loads(u1_s1.get(f'{reverse(LIST_URL)}?query=''&limit=1').content)
     assert len(response['results']) == 1
 
+    response = json.loads(u1_s1.get(f'{reverse(LIST_URL)}?limit=1&random=true').content)
+    assert len(response['results']) == 1
+
+    response = json.loads(u1_s1.get(f'{reverse(LIST_URL)}?limit=5&random=true&extended=1').content)
+    assert len(response['results']) == 2
+
     response = json.loads(u1_s1.get(f'{reverse(LIST_URL)}?query=chicken').content)
     assert response['count'] == 0
 
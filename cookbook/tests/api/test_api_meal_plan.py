@@ -3,10 +3,12 @@ from datetime import datetime, timedelta
 
 import pytest
 from django.contrib import auth
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django_scopes import scope, scopes_disabled
 
-from cookbook.models import Food, MealPlan, MealType
+from cookbook.models import CookLog, Food, MealPlan, MealType, NutritionInformation, ShoppingListRecipe
 from cookbook.tests.factories import RecipeFactory
 
 LIST_URL = 'api:mealplan-list'
@@ -156,3 +158,88 @@ def test_add_with_shopping(u1_s1, meal_type):
     )
 
     assert len(json.loads(u1_s1.get(reverse('api:shoppinglistentry-list')).content)) == 10
+
+
+def test_list_query_count(space_1, u1_s1, meal_type):
+    user = auth.get_user(u1_s1)
+
+    def add_plans(count):
+        with scopes_disabled():
+            for x in range(count):
+                plan = MealPlan.objects.create(
+                    recipe=RecipeFactory(space=space_1, created_by=user, keywords__count=2), space=space_1, meal_type=meal_type,
+                    date=datetime.now() + timedelta(days=x), created_by=user
+                )
+                plan.shared.add(auth.get_user(u1_s1))
+            CookLog.objects.create(recipe=plan.recipe, created_by=user, rating=4, space=space_1)
+            ShoppingListRecipe.objects.create(recipe=plan.recipe, mealplan=plan, servings=1)
+
+    queries = []
+    for count in [2, 6]:
+        add_plans(count)
+        with CaptureQueriesContext(connection) as context:
+            r = json.loads(u1_s1.get(reverse(LIST_URL)).content)
+        queries.append(len(context.captured_queries))
+    # the number of queries does not depend on the number of meal plans
+    assert queries[0] == queries[1]
+    assert len(r) == 8
+    assert [x['shopping'] for x in r].count(True) == 2
+    assert [x['recipe']['rating'] for x in r].count(4) == 2
+    assert all(len(x['recipe']['keywords']) == 2 for x in r)
+
+
+def test_list_shared_space(obj_1, u1_s1, u2_s1, u1_s2):
+    with scopes_disabled():
+        obj_1.shared.add(auth.get_user(u2_s1), auth.get_user(u1_s2))
+
+    r = json.loads(u1_s1.get(reverse(LIST_URL)).content)
+    # users of another space are not shown
+    assert [x['id'] for x in r[0]['shared']] == [auth.get_user(u2_s1).id]
+
+
+def test_ical(obj_1, obj_2, u1_s1, u1_s2):
+    url = reverse('api_get_plan_ical', args=['2000-01-01', '2100-01-01'])
+    r = u1_s1.get(url)
+    assert r.status_code == 200
+    content = b''.join(r.streaming_content).decode()
+    assert content.startswith('BEGIN:VCALENDAR') and content.endswith('END:VCALENDAR\r\n')
+    assert content.count('BEGIN:VEVENT') == 2
+    assert f'SUMMARY:{obj_1.meal_type.name}: {obj_1.get_label()}' in content
+    assert b''.join(u1_s2.get(url).streaming_content).count(b'BEGIN:VEVENT') == 0
+
+    # an unchanged feed is not read again
+    with CaptureQueriesContext(connection) as context:
+        r = u1_s1.get(url, HTTP_IF_NONE_MATCH=r['ETag'], HTTP_IF_MODIFIED_SINCE=r['Last-Modified'])
+    assert r.status_code == 304
+    assert not [q for q in context.captured_queries if 'cookbook_mealplan' in q['sql']]
+
+    with scopes_disabled():
+        obj_2.title = 'changed'
+        obj_2.save()
+    r = u1_s1.get(url, HTTP_IF_NONE_MATCH=r['ETag'])
+    assert r.status_code == 200
+    assert 'changed' in b''.join(r.streaming_content).decode()
+
+
+def test_nutrition(space_1, u1_s1, u1_s2, recipe_1_s1, recipe_2_s1, meal_type):
+    user = auth.get_user(u1_s1)
+    with scopes_disabled():
+        dinner = MealType.objects.create(name='dinner', order=1, space=space_1, created_by=user)
+        for recipe, servings, calories in [(recipe_1_s1, 2, 800), (recipe_2_s1, 4, 1000)]:
+            recipe.servings = servings
+            recipe.nutrition = NutritionInformation.objects.create(calories=calories, proteins=servings, space=space_1)
+            recipe.save()
+        today = datetime.now().date()
+        for recipe, date, mtype, servings in [(recipe_1_s1, today, meal_type, 1), (recipe_2_s1, today, meal_type, 2),
+                                              (recipe_2_s1, today, dinner, 4), (recipe_1_s1, today + timedelta(days=1), dinner, 2),
+                                              (None, today, dinner, 1), (recipe_1_s1, today + timedelta(days=9), dinner, 1)]:
+            MealPlan.objects.create(recipe=recipe, title='note', space=space_1, meal_type=mtype, date=date, servings=servings, created_by=user)
+
+    url = f'{reverse("api:mealplan-nutrition")}?from_date={today}&to_date={today + timedelta(days=7)}'
+    r = json.loads(u1_s1.get(url).content)
+    assert [x['date'] for x in r] == [str(today), str(today + timedelta(days=1))]
+    assert r[0]['calories'] == 400 + 500 + 1000
+    assert r[0]['proteins'] == 1 + 2 + 4
+    assert [(x['name'], x['calories']) for x in r[0]['meal_types']] == [('test', 900), ('dinner', 1000)]
+    assert r[1]['calories'] == 800
+    assert json.loads(u1_s2.get(url).content) == []
@@ -1,11 +1,17 @@
 import json
 
 import pytest
+from django.contrib import auth
+from django.core.cache import caches
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django_scopes import scopes_disabled
 
-from cookbook.models import Recipe
+from cookbook.models import (CookLog, Food, Ingredient, Keyword, Recipe, SearchFields, SearchPreference,
+                             Step)
 from cookbook.tests.conftest import get_random_json_recipe, validate_recipe
+from recipes import settings
 
 LIST_URL = 'api:recipe-list'
 DETAIL_URL = 'api:recipe-detail'
@@ -111,3 +117,205 @@ def test_delete(u1_s1, u1_s2, recipe_1_s1):
 
         assert r.status_code == 204
         assert not Recipe.objects.filter(pk=recipe_1_s1.id).exists()
+
+
+def test_list_cursor(recipe_1_s1, u1_s1, space_1):
+    with scopes_disabled():
+        for x in range(4):
+            Recipe.objects.create(name=f'cursor {x}', internal=True, created_by=auth.get_user(u1_s1), space=space_1)
+
+    r = json.loads(u1_s1.get(f'{reverse(LIST_URL)}?cursor=&count=true&page_size=2&query=cursor&new=true&last_viewed=3').content)
+    assert r['count'] == 4
+    assert r['facets']
+    recipes = [x['id'] for x in r['results']]
+    while r['next']:
+        r = json.loads(u1_s1.get(r['next']).content)
+        assert r['count'] is None
+        recipes += [x['id'] for x in r['results']]
+    assert len(recipes) == len(set(recipes)) == 4
+
+    assert u1_s1.get(f'{reverse(LIST_URL)}?cursor=invalid').status_code == 404
+
+
+@pytest.mark.parametrize("fulltext", [True, False])
+def test_list_cursor_score(fulltext, u1_s1, space_1):
+    user = auth.get_user(u1_s1)
+    with scopes_disabled():
+        if fulltext:
+            user.searchpreference.search = SearchPreference.WEB
+            user.searchpreference.fulltext.set(SearchFields.objects.all())
+        else:
+            user.searchpreference.search = SearchPreference.SIMPLE
+            user.searchpreference.trigram.set(SearchFields.objects.filter(field='name'))
+            user.searchpreference.trigram_threshold = 0.01
+        user.searchpreference.save()
+        for name in ['soup', 'tomato soup', 'soup of the day', 'soup soup', 'a soup with a long name']:
+            Recipe.objects.create(name=name, description='soup', internal=True, created_by=user, space=space_1)
+
+    url = f'{reverse(LIST_URL)}?query=soup&page_size=2'
+    recipes = [x['id'] for x in json.loads(u1_s1.get(f'{url}&page_size=25').content)['results']]
+    r = json.loads(u1_s1.get(f'{url}&cursor=').content)
+    paged = [x['id'] for x in r['results']]
+    while r['next']:
+        r = json.loads(u1_s1.get(r['next']).content)
+        paged += [x['id'] for x in r['results']]
+    # recipes with an equal score are neither repeated nor skipped
+    assert len(paged) == len(set(paged)) == 5
+    assert sorted(paged) == sorted(recipes)
+
+
+@pytest.mark.skipif(not settings.DATABASES['default']['ENGINE'].startswith('django.db.backends.postgresql'), reason='trigram search needs postgres')
+def test_list_trigram(u1_s1, space_1):
+    user = auth.get_user(u1_s1)
+    with scopes_disabled():
+        user.searchpreference.search = SearchPreference.SIMPLE
+        for fields in [user.searchpreference.icontains, user.searchpreference.istartswith, user.searchpreference.fulltext]:
+            fields.clear()
+        user.searchpreference.trigram.set(SearchFields.objects.filter(field__in=['name', 'description']))
+        user.searchpreference.trigram_threshold = 0.6
+        user.searchpreference.save()
+        match = Recipe.objects.create(name='tomato soup', internal=True, created_by=user, space=space_1)
+        Recipe.objects.create(name='tomato', description='soup', internal=True, created_by=user, space=space_1)
+
+    # one field has to be similar enough, the similarities of several fields are not added up
+    r = json.loads(u1_s1.get(f'{reverse(LIST_URL)}?query=tomato soup').content)
+    assert [x['id'] for x in r['results']] == [match.id]
+
+
+def test_list_result_cache(u1_s1, space_1, monkeypatch):
+    monkeypatch.setattr(settings, 'RECIPE_RESULT_CACHE', True)
+    with scopes_disabled():
+        for x in range(3):
+            Recipe.objects.create(name=f'cached {x}', internal=True, created_by=auth.get_user(u1_s1), space=space_1)
+
+    r = json.loads(u1_s1.get(f'{reverse(LIST_URL)}?query=cached&page_size=2').content)
+    assert r['count'] == 3
+    recipes = [x['id'] for x in r['results']]
+    r = json.loads(u1_s1.get(r['next']).content)
+    recipes += [x['id'] for x in r['results']]
+    assert len(set(recipes)) == 3
+
+    # any change of recipe data in the space invalidates the cached result
+    with scopes_disabled():
+        Recipe.objects.create(name='cached 3', internal=True, created_by=auth.get_user(u1_s1), space=space_1)
+    assert json.loads(u1_s1.get(f'{reverse(LIST_URL)}?query=cached&page_size=2').content)['count'] == 4
+
+    # moving a keyword changes the recipes found by its parent
+    with scopes_disabled():
+        parent = Keyword.add_root(name='cached parent', space=space_1)
+        child = Keyword.add_root(name='cached child', space=space_1)
+        Recipe.objects.get(name='cached 3').keywords.add(child)
+    assert json.loads(u1_s1.get(f'{reverse(LIST_URL)}?keywords={parent.id}').content)['count'] == 0
+    assert u1_s1.put(reverse('api:keyword-move', args=[child.id, parent.id])).status_code == 200
+    assert json.loads(u1_s1.get(f'{reverse(LIST_URL)}?keywords={parent.id}').content)['count'] == 1
+
+
+def test_list_query_count(u1_s1, space_1):
+    with scopes_disabled():
+        user = auth.get_user(u1_s1)
+        keyword = Keyword.objects.create(name='query count', space=space_1)
+        for x in range(10):
+            recipe = Recipe.objects.create(name=f'query count {x}', internal=True, created_by=user, space=space_1)
+            recipe.keywords.add(keyword)
+            CookLog.objects.create(recipe=recipe, rating=x % 5 + 1, created_by=user, space=space_1)
+
+    u1_s1.get(f'{reverse(LIST_URL)}?page_size=10')
+    queries = []
+    for page_size in [2, 10]:
+        with CaptureQueriesContext(connection) as context:
+            r = json.loads(u1_s1.get(f'{reverse(LIST_URL)}?page_size={page_size}').content)
+        queries.append(len(context.captured_queries))
+        assert len(r['results']) == page_size
+        assert all(x['rating'] and x['last_cooked'] and x['keywords'] for x in r['results'])
+    # rating, last cooked and keywords must not be loaded per recipe
+    assert queries[0] == queries[1]
+
+
+def test_list_fulltext(u1_s1, space_1):
+    with scopes_disabled():
+        user = auth.get_user(u1_s1)
+        user.searchpreference.icontains.clear()
+        user.searchpreference.trigram.clear()
+        user.searchpreference.fulltext.set(SearchFields.objects.all())
+        pie = Recipe.objects.create(name='apple pie', internal=True, created_by=user, space=space_1)
+        pie.keywords.add(Keyword.objects.create(name='dessert', space=space_1))
+        tart = Recipe.objects.create(name='pear tart', description='made with apples', internal=True, created_by=user, space=space_1)
+
+    r = json.loads(u1_s1.get(f'{reverse(LIST_URL)}?query=apple').content)
+    assert [x['id'] for x in r['results']] == [pie.id, tart.id]
+    r = json.loads(u1_s1.get(f'{reverse(LIST_URL)}?query=dessert').content)
+    assert [x['id'] for x in r['results']] == [pie.id]
+
+    with scopes_disabled():
+        user.searchpreference.fulltext.set(SearchFields.objects.filter(field='name'))
+    r = json.loads(u1_s1.get(f'{reverse(LIST_URL)}?query=dessert').content)
+    assert r['count'] == 0
+
+
+def test_search_document_food(u1_s1, space_1):
+    with scopes_disabled():
+        user = auth.get_user(u1_s1)
+        user.searchpreference.icontains.clear()
+        user.searchpreference.trigram.clear()
+        user.searchpreference.fulltext.set(SearchFields.objects.all())
+        food = Food.objects.create(name='pumpkin', space=space_1)
+        recipe = Recipe.objects.create(name='orange soup', internal=True, created_by=user, space=space_1)
+        step = Step.objects.create(instruction='cook', space=space_1)
+        recipe.steps.add(step)
+        step.ingredients.add(Ingredient.objects.create(food=food, amount=1, space=space_1))
+
+    def found(query):
+        return [x['id'] for x in json.loads(u1_s1.get(f'{reverse(LIST_URL)}?query={query}').content)['results']]
+
+    assert found('pumpkin') == [recipe.id]
+    with scopes_disabled():
+        # saves that do not change the name keep the documents of the recipes using the food
+        with CaptureQueriesContext(connection) as context:
+            food.description = 'orange'
+            food.save()
+        assert not [q for q in context.captured_queries if 'UPDATE "cookbook_recipe"' in q['sql'] or 'cookbook_recipe_fts' in q['sql']]
+        food.name = 'squash'
+        food.save()
+    assert found('squash') == [recipe.id]
+    assert found('pumpkin') == []
+
+
+def test_facets(recipe_1_s1, recipe_2_s1, u1_s1, space_1):
+    with scopes_disabled():
+        space_1.show_facet_count = True
+        space_1.save()
+        root = Keyword.add_root(name='facet root', space=space_1)
+        child = root.add_child(name='facet child', space=space_1)
+        recipe_1_s1.keywords.add(root)
+        recipe_2_s1.keywords.add(child)
+
+    cache_key = json.loads(u1_s1.get(reverse(LIST_URL)).content)['facets']['cache_key']
+    r = json.loads(u1_s1.get(f"{reverse('api_get_facets')}?hash={cache_key}").content)
+    keywords = {x['name']: x for x in r['facets']['Keywords']}
+    assert keywords['facet root']['count'] == 2
+
+    r = json.loads(u1_s1.get(f"{reverse('api_get_facets')}?hash={cache_key}&keyword={root.id}").content)
+    children = next(x for x in r['facets']['Keywords'] if x['id'] == root.id)['children']
+    assert [(x['name'], x['count']) for x in children] == [('facet child', 1)]
+
+    # the search is built again from its cached parameters to count the children of a filtered result
+    with scopes_disabled():
+        recipe_1_s1.keywords.add(root.add_child(name='facet other', space=space_1))
+    cache_key = json.loads(u1_s1.get(f'{reverse(LIST_URL)}?keywords={child.id}').content)['facets']['cache_key']
+    assert caches['default'].get(f'recipes_filter_{cache_key}')['search'] == {'keywords': str(child.id)}
+    u1_s1.get(f"{reverse('api_get_facets')}?hash={cache_key}")
+    r = json.loads(u1_s1.get(f"{reverse('api_get_facets')}?hash={cache_key}&keyword={root.id}").content)
+    children = next(x for x in r['facets']['Keywords'] if x['id'] == root.id)['children']
+    assert [(x['name'], x['count']) for x in children] == [('facet child', 1)]
+
+
+def test_facets_cache_key(u1_s1, space_1):
+    with scopes_disabled():
+        keywords = [Keyword.objects.create(name=name, space=space_1) for name in ['first', 'second']]
+        recipes = [Recipe.objects.create(name=f'recipe {x}', internal=True, created_by=auth.get_user(u1_s1), space=space_1) for x in range(9)]
+        # both results have the same count, minimum, maximum, sum and sum of squares of their ids
+        for keyword, offsets in zip(keywords, [[0, 1, 5, 6, 8], [0, 2, 3, 7, 8]]):
+            keyword.recipe_set.add(*[recipes[x] for x in offsets])
+
+    cache_keys = [json.loads(u1_s1.get(f'{reverse(LIST_URL)}?keywords={k.id}').content)['facets']['cache_key'] for k in keywords]
+    assert cache_keys[0] != cache_keys[1]
@@ -7,7 +7,7 @@ from django.urls import reverse
 from django_scopes import scopes_disabled
 from pytest_factoryboy import LazyFixture, register
 
-from cookbook.tests.factories import RecipeFactory
+from cookbook.tests.factories import RecipeFactory, StepFactory
 
 RELATED_URL = 'api:recipe-related'
 
@@ -65,9 +65,30 @@ def test_related_mixed_space(request, recipe,  u1_s2):
             reverse(RELATED_URL, args={recipe.id})).content)) == 0
 
 
-# TODO if/when related recipes includes multiple levels (related recipes of related recipes) add the following tests
-#   -- step recipes included in step recipes
-#   -- step recipes included in food recipes
-#   -- food recipes included in step recipes
-#   -- food recipes included in food recipes
-#   -- -- included recipes in the wrong space
+def test_related_levels(u1_s1, space_1, space_2, django_assert_num_queries):
+    with scopes_disabled():
+        user = auth.get_user(u1_s1)
+        recipe_1, recipe_2, recipe_3, recipe_4 = [RecipeFactory(created_by=user, space=space_1) for x in range(4)]
+        other_space = RecipeFactory(space=space_2)
+        # 1 uses 2 as step recipe, 2 uses 3 as food recipe, 3 uses 1 again and a recipe of another space
+        recipe_1.steps.add(StepFactory(step_recipe=recipe_2, ingredients__count=0, space=space_1))
+        food = recipe_2.steps.first().ingredients.first().food
+        food.recipe = recipe_3
+        food.save()
+        recipe_3.steps.add(StepFactory(step_recipe=recipe_1, ingredients__count=0, space=space_1))
+        recipe_3.steps.add(StepFactory(step_recipe=other_space, ingredients__count=0, space=space_1))
+
+    def related(levels):
+        return [x['id'] for x in json.loads(u1_s1.get(reverse(RELATED_URL, args={recipe_1.id}), {'levels': levels}).content)]
+
+    assert related(1) == [recipe_2.id]
+    assert sorted(related(2)) == sorted([recipe_2.id, recipe_3.id])
+    assert sorted(related(0)) == sorted([recipe_2.id, recipe_3.id])
+
+    with scopes_disabled():
+        # the graph is cached
+        with django_assert_num_queries(0):
+            assert recipe_1.get_related_recipe_ids() == [recipe_2.id, recipe_3.id]
+        # and read again after a step changed
+        recipe_3.steps.add(StepFactory(step_recipe=recipe_4, ingredients__count=0, space=space_1))
+        assert recipe_1.get_related_recipe_ids() == [recipe_2.id, recipe_3.id, recipe_4.id]
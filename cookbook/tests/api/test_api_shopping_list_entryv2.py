@@ -4,14 +4,20 @@ from datetime import timedelta
 import factory
 import pytest
 from django.contrib import auth
+from django.contrib.auth.models import User
+from django.db import connection
 from django.forms import model_to_dict
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
 from django_scopes import scopes_disabled
 from pytest_factoryboy import LazyFixture, register
 
-from cookbook.models import ShoppingListEntry
-from cookbook.tests.factories import ShoppingListEntryFactory
+from cookbook.helper.permission_helper import is_object_owner, is_object_shared
+from cookbook.models import (ShoppingListEntry, ShoppingListRecipe, Supermarket, SupermarketCategory,
+                             SupermarketCategoryRelation, UserPreference)
+from cookbook.tests.factories import RecipeFactory, ShoppingListEntryFactory
+from recipes import settings
 
 LIST_URL = 'api:shoppinglistentry-list'
 DETAIL_URL = 'api:shoppinglistentry-detail'
@@ -220,3 +226,236 @@ def test_recent(sle, u1_s1):
 
 
 # TODO test auto onhand
+
+
+def test_since(sle, u1_s1):
+    r = json.loads(u1_s1.get(reverse(LIST_URL), {'since': ''}).content)
+    assert len(r['results']) == 10
+    assert r['deleted'] == []
+    with scopes_disabled():
+        ShoppingListEntry.objects.update(updated_at=timezone.now() - timedelta(hours=1))
+
+    r = json.loads(u1_s1.get(reverse(LIST_URL), {'since': r['token']}).content)
+    assert r['results'] == [] and r['deleted'] == []
+
+    u1_s1.patch(reverse(DETAIL_URL, args={sle[0].id}), {'checked': True}, content_type='application/json')
+    u1_s1.delete(reverse(DETAIL_URL, args={sle[1].id}))
+    r = json.loads(u1_s1.get(reverse(LIST_URL), {'since': r['token'], 'checked': 'false'}).content)
+    assert [x['id'] for x in r['results']] == [sle[0].id]
+    assert r['deleted'] == [sle[1].id]
+
+    assert u1_s1.get(reverse(LIST_URL), {'since': 'invalid'}).status_code == 400
+    # deleted entries are only remembered for SHOPPING_SYNC_RETENTION_DAYS
+    expired = (timezone.now() - timedelta(days=settings.SHOPPING_SYNC_RETENTION_DAYS + 1)).isoformat()
+    assert u1_s1.get(reverse(LIST_URL), {'since': expired}).status_code == 400
+
+
+def test_events(sle, u1_s1, u1_s2, monkeypatch):
+    # every open stream occupies a worker thread, the stream is disabled by default
+    assert u1_s1.get(reverse('api_shopping_events')).status_code == 404
+    monkeypatch.setattr(settings, 'ENABLE_SHOPPING_EVENTS', True)
+    monkeypatch.setattr(settings, 'SHOPPING_EVENT_STREAM_TIMEOUT', 0)
+
+    def events(client, **headers):
+        stream = b''.join(client.get(reverse('api_shopping_events'), **headers).streaming_content).decode()
+        return [dict(line.split(': ', 1) for line in e.split('\n')) for e in stream.split('\n\n') if e.startswith('id: ')]
+
+    r = events(u1_s1)
+    assert {(e['event'], json.loads(e['data'])['id']) for e in r} == {('add', x.id) for x in sle}
+    assert events(u1_s2) == []
+
+    with scopes_disabled():
+        ShoppingListEntry.objects.update(created_at=timezone.now() - timedelta(hours=1), updated_at=timezone.now() - timedelta(hours=1))
+    last_event = r[-1]['id']
+    u1_s1.patch(reverse(DETAIL_URL, args={sle[0].id}), {'checked': True}, content_type='application/json')
+    u1_s1.delete(reverse(DETAIL_URL, args={sle[1].id}))
+    r = events(u1_s1, HTTP_LAST_EVENT_ID=last_event)
+    assert [(e['event'], json.loads(e['data'])['id']) for e in r] == [('check', sle[0].id), ('delete', sle[1].id)]
+    assert json.loads(r[0]['data'])['checked']
+    assert events(u1_s2) == []
+
+
+def test_shopping_share_cache(sle, u1_s1, u2_s1, django_assert_num_queries, monkeypatch):
+    monkeypatch.setattr(settings, 'SHOPPING_SHARE_CACHE_TIMEOUT', 60)
+    user = auth.get_user(u1_s1)
+    shared_user = auth.get_user(u2_s1)
+    with scopes_disabled():
+        entry = ShoppingListEntryFactory.create_batch(3, space=shared_user.userpreference.space, created_by=shared_user)[0].id
+
+    assert len(json.loads(u1_s1.get(reverse(LIST_URL)).content)) == 10
+    # the share set resolved by the request is cached
+    with django_assert_num_queries(0):
+        assert user.get_shopping_share_ids() == []
+
+    # changing the share preference invalidates the cached share set of the affected user
+    shared_user.userpreference.shopping_share.add(user)
+    assert len(json.loads(u1_s1.get(reverse(LIST_URL)).content)) == 13
+    shared_user.userpreference.shopping_share.clear()
+    assert len(json.loads(u1_s1.get(reverse(LIST_URL)).content)) == 10
+
+    # permissions use the current setting, also while another worker still has the old share set cached
+    shared_user.userpreference.shopping_share.add(user)
+    assert u1_s1.patch(reverse(DETAIL_URL, args={entry}), {'amount': 2}, content_type='application/json').status_code == 200
+    UserPreference.shopping_share.through.objects.filter(user=user).delete()
+    assert u1_s1.patch(reverse(DETAIL_URL, args={entry}), {'amount': 3}, content_type='application/json').status_code == 404
+
+    # deleting a user removes them from the cached share sets
+    shared_user.userpreference.shopping_share.add(user)
+    assert User.objects.get(id=user.id).get_shopping_share_ids() == [shared_user.id]
+    shared_user.delete()
+    assert User.objects.get(id=user.id).get_shopping_share_ids() == []
+
+    # without a timeout the share set is only kept for the request
+    monkeypatch.setattr(settings, 'SHOPPING_SHARE_CACHE_TIMEOUT', 0)
+    assert len(json.loads(u1_s1.get(reverse(LIST_URL)).content)) == 10
+    user = User.objects.get(id=user.id)
+    with django_assert_num_queries(1):
+        assert user.get_shopping_share_ids() == []
+
+
+def test_onhand(sle, u1_s1):
+    user = auth.get_user(u1_s1)
+    with scopes_disabled():
+        sle[0].food.onhand_users.add(user)
+
+    # the on hand status of all foods is prefetched at once
+    u1_s1.get(reverse(LIST_URL), {'checked': 'false'})
+    with CaptureQueriesContext(connection) as context:
+        r = json.loads(u1_s1.get(reverse(LIST_URL), {'checked': 'false'}).content)
+    assert [x['id'] for x in r if x['food']['food_onhand']] == [sle[0].id]
+    with scopes_disabled():
+        ShoppingListEntryFactory.create_batch(5, space=user.userpreference.space, created_by=user)
+    with CaptureQueriesContext(connection) as more_entries:
+        u1_s1.get(reverse(LIST_URL), {'checked': 'false'})
+    assert len(more_entries.captured_queries) == len(context.captured_queries)
+
+
+def test_aggregate(sle, u1_s1):
+    user = auth.get_user(u1_s1)
+    space = user.userpreference.space
+    with scopes_disabled():
+        recipe = RecipeFactory(space=space, created_by=user, steps__count=0)
+        list_recipes = [ShoppingListRecipe.objects.create(recipe=recipe, servings=1), ShoppingListRecipe.objects.create(recipe=recipe, servings=1), None]
+        merged = [
+            ShoppingListEntryFactory(space=space, created_by=user, food=sle[0].food, unit=sle[0].unit, list_recipe=list_recipe)
+            for list_recipe in list_recipes
+        ] + [sle[0]]
+        ShoppingListEntryFactory(space=space, created_by=user, food=sle[0].food, unit=sle[0].unit, checked=True, completed_at=timezone.now())
+
+    r = json.loads(u1_s1.get(reverse(LIST_URL), {'aggregate': 'true'}).content)
+    # 9 other entries, the merged unchecked entries and the checked entry of the same food
+    assert len(r) == 11
+    row = [x for x in r if x['food'] == sle[0].food.id and not x['checked']][0]
+    assert row['entries'] == sorted(x.id for x in merged)
+    assert row['amount'] == pytest.approx(float(sum(x.amount for x in merged)))
+    assert row['recipes'] == [recipe.name]
+    assert row['food_name'] == sle[0].food.name
+    # checked entries come last
+    assert r[-1]['checked']
+
+    r = json.loads(u1_s1.get(reverse(LIST_URL), {'aggregate': 'true', 'checked': 'false'}).content)
+    assert len(r) == 10
+
+    # delayed entries are hidden like in the shopping list and never merged with entries that are not delayed
+    with scopes_disabled():
+        ShoppingListEntry.objects.filter(id=merged[0].id).update(delay_until=timezone.now() + timedelta(hours=1))
+    r = json.loads(u1_s1.get(reverse(LIST_URL), {'aggregate': 'true', 'checked': 'false'}).content)
+    row = [x for x in r if x['food'] == sle[0].food.id][0]
+    assert row['entries'] == sorted(x.id for x in merged[1:])
+    r = json.loads(u1_s1.get(reverse(LIST_URL), {'aggregate': 'true', 'checked': 'false', 'delayed': 'true'}).content)
+    assert len(r) == 11
+    assert [x['entries'] for x in r if x['delayed']] == [[merged[0].id]]
+
+
+def test_supermarket_order(sle, u1_s1, u1_s2):
+    space = auth.get_user(u1_s1).userpreference.space
+    with scopes_disabled():
+        supermarket = Supermarket.objects.create(name='market', space=space)
+        supermarket_id = supermarket.id
+        categories = [SupermarketCategory.objects.create(name=f'aisle {x}', space=space) for x in range(3)]
+        for entry, category in zip(sle, categories):
+            entry.food.supermarket_category = category
+            entry.food.save()
+        SupermarketCategoryRelation.objects.create(supermarket=supermarket, category=categories[2], order=0)
+        relation = SupermarketCategoryRelation.objects.create(supermarket=supermarket, category=categories[0], order=1)
+
+    def foods():
+        return [x['food']['id'] for x in json.loads(u1_s1.get(reverse(LIST_URL), {'supermarket': supermarket_id, 'checked': 'false'}).content)]
+
+    r = foods()
+    # categories that are not in the supermarket come last
+    assert r[:2] == [sle[2].food.id, sle[0].food.id]
+    with CaptureQueriesContext(connection) as context:
+        assert foods() == r
+    assert not [q for q in context.captured_queries if 'cookbook_supermarketcategoryrelation' in q['sql']]
+
+    with scopes_disabled():
+        relation.order = -1
+        relation.save()
+    # a supermarket of another space does not change the order, nor the order cached for its own space
+    assert json.loads(u1_s2.get(reverse(LIST_URL), {'supermarket': supermarket_id, 'checked': 'false'}).content) == []
+    assert foods()[:2] == [sle[0].food.id, sle[2].food.id]
+
+    with scopes_disabled():
+        with CaptureQueriesContext(connection) as context:
+            supermarket.delete()
+    # the cache of the deleted relations is cleared without loading their supermarket again
+    assert not [q for q in context.captured_queries if q['sql'].startswith('SELECT') and 'FROM "cookbook_supermarket"' in q['sql']]
+    assert len(foods()) == 10
+
+
+def test_bulk(sle, u1_s1, u2_s1, u1_s2):
+    user = auth.get_user(u1_s1)
+    user.userpreference.shopping_add_onhand = True
+    user.userpreference.save()
+    user.userpreference.shopping_share.add(auth.get_user(u2_s1))
+    url = reverse('api:shoppinglistentry-bulk')
+
+    assert u1_s1.post(url, {'checked': True}, content_type='application/json').status_code == 400
+    assert u1_s1.post(url, {'ids': [sle[0].id]}, content_type='application/json').status_code == 400
+
+    r = u1_s1.post(url, {'ids': [x.id for x in sle[:5]], 'checked': True}, content_type='application/json')
+    assert sorted(json.loads(r.content)['entries']) == sorted(x.id for x in sle[:5])
+    with scopes_disabled():
+        checked = ShoppingListEntry.objects.filter(checked=True)
+        assert sorted(checked.values_list('id', flat=True)) == sorted(x.id for x in sle[:5])
+        assert checked.filter(completed_at__isnull=True).count() == 0
+        assert checked.filter(food__onhand_users=user).count() == 5
+        assert checked.filter(food__onhand_users=auth.get_user(u2_s1)).count() == 5
+
+    # other users can only change entries shared with them
+    r = u1_s2.post(url, {'ids': [x.id for x in sle], 'checked': False}, content_type='application/json')
+    assert json.loads(r.content)['entries'] == []
+
+    delay = timezone.now() + timedelta(hours=2)
+    u1_s1.post(url, {'food': sle[0].food.id, 'checked': False, 'delay_until': delay.isoformat()}, content_type='application/json')
+    with scopes_disabled():
+        entry = ShoppingListEntry.objects.get(id=sle[0].id)
+        assert not entry.checked and entry.completed_at is None and entry.delay_until == delay
+        assert not entry.food.onhand_users.exists()
+        assert entry.updated_at > sle[0].updated_at
+
+
+def test_object_permission(sle, u1_s1, u2_s1, django_assert_num_queries):
+    user_1, user_2 = auth.get_user(u1_s1), auth.get_user(u2_s1)
+    with scopes_disabled():
+        user_1.userpreference.shopping_share.add(user_2)
+        list_recipe = ShoppingListRecipe.objects.create(recipe=RecipeFactory(space=sle[0].space), servings=1)
+        ShoppingListEntry.objects.filter(id=sle[0].id).update(list_recipe=list_recipe)
+    # loaded once per request
+    user_1.get_shopping_share_ids()
+    user_2.get_shopping_share_ids()
+
+    # every check is a single query on the primary key
+    for obj in [sle[0], list_recipe]:
+        with django_assert_num_queries(1):
+            assert is_object_owner(user_1, obj)
+        with django_assert_num_queries(1):
+            assert not is_object_owner(user_2, obj)
+        with django_assert_num_queries(1):
+            assert is_object_shared(user_2, obj)
+        with django_assert_num_queries(1):
+            assert not is_object_shared(user_1, obj)
+
+    assert u2_s1.get(reverse(DETAIL_URL, args={sle[0].id})).status_code == 200
+    assert u2_s1.get(reverse('api:shoppinglistrecipe-detail', args={list_recipe.id})).status_code == 200
@@ -6,12 +6,15 @@ import pytest
 # work around for bug described here https://stackoverflow.com/a/70312265/15762829
 from django.conf import settings
 from django.contrib import auth
+from django.db import connection, transaction
 from django.forms import model_to_dict
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
 from django_scopes import scope, scopes_disabled
 from pytest_factoryboy import LazyFixture, register
 
+from cookbook.helper.shopping_helper import list_from_recipe
 from cookbook.models import Food, Ingredient, ShoppingListEntry, Step
 from cookbook.tests.factories import (IngredientFactory, MealPlanFactory, RecipeFactory,
                                       StepFactory, UserFactory)
@@ -113,7 +116,7 @@ def test_shopping_recipe_method(request, arg, recipe, sle_count,  u1_s1, u2_s1):
     ({'steps__food_recipe_count': {'step': 0, 'count': 1}, 'steps__recipe_count': 1}, 29),  # shopping list from recipe with StepRecipe and food recipe
 ], indirect=['recipe'])
 @pytest.mark.parametrize("use_mealplan", [(False), (True), ])
-def test_shopping_recipe_edit(request, recipe, sle_count, use_mealplan, u1_s1, u2_s1):
+def test_shopping_recipe_edit(request, recipe, sle_count, use_mealplan, u1_s1, u2_s1, django_capture_on_commit_callbacks):
     # tests editing shopping list via recipe or mealplan
     with scopes_disabled():
         user = auth.get_user(u1_s1)
@@ -124,7 +127,9 @@ def test_shopping_recipe_edit(request, recipe, sle_count, use_mealplan, u1_s1, u
         user.userpreference.save()
 
         if use_mealplan:
-            mealplan = MealPlanFactory(space=recipe.space, created_by=user, servings=recipe.servings, recipe=recipe)
+            # meal plans are added to the shopping list after the transaction commits
+            with django_capture_on_commit_callbacks(execute=True):
+                mealplan = MealPlanFactory(space=recipe.space, created_by=user, servings=recipe.servings, recipe=recipe)
         else:
             u1_s1.put(reverse(SHOPPING_RECIPE_URL, args={recipe.id}))
         r = json.loads(u1_s1.get(reverse(SHOPPING_LIST_URL)).content)
@@ -192,7 +197,7 @@ def test_shopping_recipe_edit(request, recipe, sle_count, use_mealplan, u1_s1, u
 ], indirect=['user2'])
 @pytest.mark.parametrize("use_mealplan", [(False), (True), ])
 @pytest.mark.parametrize("recipe", [({'steps__recipe_count': 1})], indirect=['recipe'])
-def test_shopping_recipe_userpreference(recipe, sle_count, use_mealplan, user2):
+def test_shopping_recipe_userpreference(recipe, sle_count, use_mealplan, user2, django_capture_on_commit_callbacks):
     with scopes_disabled():
         user = auth.get_user(user2)
         # setup recipe with 10 ingredients, 1 step recipe with 10 ingredients, 2 food onhand(from recipe and step_recipe)
@@ -206,7 +211,8 @@ def test_shopping_recipe_userpreference(recipe, sle_count, use_mealplan, user2):
         food.save()
 
         if use_mealplan:
-            mealplan = MealPlanFactory(space=recipe.space, created_by=user, servings=recipe.servings, recipe=recipe)
+            with django_capture_on_commit_callbacks(execute=True):
+                mealplan = MealPlanFactory(space=recipe.space, created_by=user, servings=recipe.servings, recipe=recipe)
             assert len(json.loads(user2.get(reverse(SHOPPING_LIST_URL)).content)) == sle_count[0]
         else:
             user2.put(reverse(SHOPPING_RECIPE_URL, args={recipe.id}))
@@ -240,3 +246,89 @@ def test_shopping_with_header_ingredient(u1_s1, recipe):
     u1_s1.put(reverse(SHOPPING_RECIPE_URL, args={recipe.id}))
     assert len(json.loads(u1_s1.get(reverse(SHOPPING_LIST_URL)).content)) == 10
     assert len(json.loads(u1_s1.get(reverse('api:ingredient-list')).content)) == 11
+
+
+def test_shopping_recipe_query_count(user2, space_1):
+    with scopes_disabled():
+        queries = []
+        for steps in [1, 3]:
+            user = auth.get_user(user2)
+            recipe = RecipeFactory(created_by=user, space=space_1, steps__count=steps, steps__recipe_count=1)
+            # the share set is cached after the first lookup
+            user.get_shopping_share_ids()
+            with CaptureQueriesContext(connection) as context:
+                list_recipe = list_from_recipe(recipe=recipe, created_by=user, space=space_1)
+                list_from_recipe(list_recipe=list_recipe, servings=2 * recipe.servings, space=space_1)
+            queries.append(len(context.captured_queries))
+            assert ShoppingListEntry.objects.filter(list_recipe=list_recipe).count() == 10 * steps + 10
+        # entries are calculated in memory and written in bulk, the number of ingredients does not matter
+        assert queries[0] == queries[1]
+
+
+def test_shopping_mealplan_batch(user2, space_1, django_capture_on_commit_callbacks):
+    with scopes_disabled():
+        user = auth.get_user(user2)
+        user.userpreference.mealplan_autoadd_shopping = False
+        user.userpreference.save()
+        recipes = [RecipeFactory(created_by=user, space=space_1, steps__recipe_count=1) for x in range(2)]
+        today = timezone.now().date()
+        plans = [
+            MealPlanFactory(space=space_1, created_by=user, recipe=recipes[x % 2], servings=recipes[x % 2].servings, date=today + timedelta(days=x))
+            for x in range(4)
+        ]
+        MealPlanFactory(space=space_1, created_by=user, has_recipe=False, date=today)
+        # plans of other users are not visible
+        MealPlanFactory(space=space_1, date=today)
+        assert ShoppingListEntry.objects.count() == 0
+
+    url = reverse('api:mealplan-shopping')
+    assert user2.post(url, {}, content_type='application/json').status_code == 400
+    r = user2.post(url, {'from_date': str(today), 'to_date': str(today + timedelta(days=2))}, content_type='application/json')
+    assert len(json.loads(r.content)['list_recipes']) == 3
+    assert len(json.loads(user2.get(reverse(SHOPPING_LIST_URL)).content)) == 3 * 20
+    # meal plans already on the shopping list are skipped
+    r = user2.post(url, {'ids': [x.id for x in plans]}, content_type='application/json')
+    assert len(json.loads(r.content)['list_recipes']) == 1
+    assert len(json.loads(user2.get(reverse(SHOPPING_LIST_URL)).content)) == 4 * 20
+
+    # meal plans saved in one transaction are added after it commits
+    with scopes_disabled():
+        user.userpreference.mealplan_autoadd_shopping = True
+        user.userpreference.save()
+        with django_capture_on_commit_callbacks(execute=True):
+            MealPlanFactory.create_batch(3, space=space_1, created_by=user, recipe=recipes[0], servings=recipes[0].servings)
+            assert ShoppingListEntry.objects.count() == 4 * 20
+        assert ShoppingListEntry.objects.count() == 7 * 20
+
+
+def test_shopping_mealplan_rollback(user2, space_1, django_capture_on_commit_callbacks):
+    with scopes_disabled():
+        user = auth.get_user(user2)
+        recipe = RecipeFactory(created_by=user, space=space_1, steps__recipe_count=1)
+        # meal plans of a rolled back savepoint are not added with the next commit
+        with django_capture_on_commit_callbacks(execute=True) as callbacks:
+            try:
+                with transaction.atomic():
+                    MealPlanFactory(space=space_1, created_by=user, recipe=recipe, servings=recipe.servings)
+                    raise ValueError()
+            except ValueError:
+                pass
+            plan = MealPlanFactory(space=space_1, created_by=user, recipe=recipe, servings=recipe.servings)
+        assert len(callbacks) == 1
+        assert callbacks[0].args == (plan.id, space_1.id)
+        assert ShoppingListEntry.objects.count() == 20
+
+
+def test_shopping_mealplan_batch_shared(user2, u2_s1, space_1):
+    with scopes_disabled():
+        user = auth.get_user(user2)
+        owner = auth.get_user(u2_s1)
+        plan = MealPlanFactory(space=space_1, created_by=owner, recipe=RecipeFactory(created_by=owner, space=space_1), date=timezone.now().date())
+        plan.shared.add(user)
+
+    # a plan shared with the user stays on the shopping list of its owner
+    url = reverse('api:mealplan-shopping')
+    r = user2.post(url, {'ids': [plan.id]}, content_type='application/json')
+    assert json.loads(r.content)['list_recipes'] == []
+    r = u2_s1.post(url, {'ids': [plan.id]}, content_type='application/json')
+    assert len(json.loads(r.content)['list_recipes']) == 1
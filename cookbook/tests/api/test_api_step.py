@@ -108,3 +108,25 @@ def test_delete(u1_s1, u1_s2, recipe_1_s1):
 
         assert r.status_code == 204
         assert not Step.objects.filter(pk=s.id).exists()
+
+
+def test_instruction_render(u1_s1, recipe_1_s1):
+    with scopes_disabled():
+        s = recipe_1_s1.steps.first()
+        s.instruction = '{{ ingredients[0].food }}'
+        s.save()
+        food = s.ingredients.first().food
+
+    r = json.loads(u1_s1.get(reverse(DETAIL_URL, args={s.id})).content)
+    assert food.name in r['ingredients_markdown']
+    assert r['ingredients_markdown'] == r['ingredients_vue']
+
+    # the rendering is cached by content, changed ingredients must not return the previous rendering
+    with scopes_disabled():
+        food.name = 'renamed food'
+        food.save()
+    r = json.loads(u1_s1.get(reverse(DETAIL_URL, args={s.id})).content)
+    assert 'renamed food' in r['ingredients_markdown']
+
+    r = json.loads(u1_s1.patch(reverse(DETAIL_URL, args={s.id}), {'instruction': 'changed'}, content_type='application/json').content)
+    assert 'changed' in r['ingredients_markdown']
@@ -7,6 +7,7 @@ import difflib
 import pytest
 from django.contrib import auth
 from django.contrib.auth.models import Group, User
+from django.core.cache import caches
 from django_scopes import scopes_disabled
 from pytest_factoryboy import LazyFixture, register
 
@@ -36,6 +37,12 @@ def enable_db_access_for_all_tests(db):
     pass
 
 
+@pytest.fixture(autouse=True)
+def clear_cache():
+    # rolled back test data can reuse ids, values cached by an earlier test must not leak into the next one
+    caches['default'].clear()
+
+
 # @pytest.fixture()
 # def space_1():
 #     with scopes_disabled():
@@ -0,0 +1,42 @@
+from django.core.cache import caches
+
+from cookbook.helper.cache_helper import TieredCache
+
+
+def test_tiered_cache():
+    cache = TieredCache('test', {'OPTIONS': {'SHARED': 'default', 'L1_TIMEOUT': 60, 'L1_MAX_ENTRIES': 10}})
+    shared = caches['default']
+
+    cache.set('tiered_key', 1)
+    assert shared.get('tiered_key') == 1
+
+    # a value written by another worker is read from the shared cache and kept in process
+    shared.set('tiered_other', 2)
+    assert cache.get('tiered_other') == 2
+    shared.delete('tiered_other')
+    assert cache.get('tiered_other') == 2
+
+    cache.delete('tiered_key')
+    assert cache.get('tiered_key') is None
+    assert shared.get('tiered_key') is None
+
+
+def test_tiered_cache_file(tmp_path, settings):
+    settings.CACHES = {**settings.CACHES, 'file': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': str(tmp_path)}}
+    # two workers with their own process memory in front of the same files
+    workers = [TieredCache(f'worker_{x}', {'OPTIONS': {'SHARED': 'file', 'L1_TIMEOUT': 60}}) for x in range(2)]
+
+    workers[0].set('tiered_key', {'a': 1}, None)
+    assert workers[1].get('tiered_key') == {'a': 1}
+    assert workers[1].get_many(['tiered_key', 'tiered_missing']) == {'tiered_key': {'a': 1}}
+
+    assert workers[0].add('tiered_counter', 1)
+    assert not workers[1].add('tiered_counter', 5)
+    assert workers[1].incr('tiered_counter') == 2
+    assert workers[0].get('tiered_counter') == 1
+    # the value kept in process memory of another worker is stale until L1_TIMEOUT, the shared cache is not
+    assert caches['file'].get('tiered_counter') == 2
+
+    workers[1].delete('tiered_key')
+    assert not caches['file'].has_key('tiered_key')
+    assert TieredCache('worker_2', {'OPTIONS': {'SHARED': 'file'}}).get('tiered_key') is None
@@ -0,0 +1,88 @@
+from datetime import timedelta
+
+from django.contrib import auth
+from django.core.management import call_command
+from django.db import connection, connections
+from django.utils import timezone
+from django_scopes import scopes_disabled
+
+from cookbook.helper.retention_helper import RETENTION_LOCK, delete_old_history
+from cookbook.models import ShoppingListEntry, ShoppingListEntryTombstone, ViewLog
+from cookbook.tests.factories import ShoppingListEntryFactory
+from recipes import settings
+
+
+def test_delete_old_history(space_1, space_2, u1_s1, u1_s2, recipe_1_s1, monkeypatch):
+    monkeypatch.setattr(settings, 'VIEW_LOG_RETENTION_DAYS', 5)
+    old = timezone.now() - timedelta(days=20)
+    with scopes_disabled():
+        space_1.shopping_retention_days = 10
+        space_1.save()
+        # space 2 keeps its view log although the server default deletes it
+        space_2.view_log_retention_days = 0
+        space_2.save()
+
+        user_1, user_2 = auth.get_user(u1_s1), auth.get_user(u1_s2)
+        deleted = ShoppingListEntryFactory.create_batch(3, space=space_1, created_by=user_1, checked=True)
+        kept = [
+            ShoppingListEntryFactory(space=space_1, created_by=user_1, checked=True),
+            ShoppingListEntryFactory(space=space_1, created_by=user_1, checked=False),
+            ShoppingListEntryFactory(space=space_2, created_by=user_2, checked=True),
+        ]
+        ShoppingListEntry.objects.filter(id__in=[x.id for x in deleted + kept[1:]]).update(completed_at=old)
+        ShoppingListEntry.objects.filter(id=kept[0].id).update(completed_at=timezone.now())
+
+        ViewLog.objects.create(recipe=recipe_1_s1, created_by=user_1, space=space_1)
+        ViewLog.objects.create(recipe=recipe_1_s1, created_by=user_2, space=space_2)
+        ViewLog.objects.update(created_at=old)
+        ViewLog.objects.create(recipe=recipe_1_s1, created_by=user_1, space=space_1)
+
+        # left behind by a deleted space
+        ShoppingListEntryTombstone.objects.create(entry_id=1, created_by=user_1, space_id=space_2.id + 100)
+
+    counts = delete_old_history(dry_run=True)
+    assert counts['shopping'] == 3 and counts['view_log'] == 1 and counts['shopping_tombstone'] == 1
+    with scopes_disabled():
+        assert ShoppingListEntry.objects.count() == 6
+
+    assert delete_old_history(batch_size=2) == counts
+    with scopes_disabled():
+        assert set(ShoppingListEntry.objects.values_list('id', flat=True)) == {x.id for x in kept}
+        assert ViewLog.objects.filter(space=space_1).count() == 1
+        assert ViewLog.objects.filter(space=space_2).count() == 1
+        # clients that synced before the cleanup still learn about the deleted entries
+        assert set(ShoppingListEntryTombstone.objects.values_list('entry_id', flat=True)) == {x.id for x in deleted}
+
+
+def test_cleanuphistory_command(space_1, space_2, u1_s1, u1_s2, recipe_1_s1, monkeypatch):
+    monkeypatch.setattr(settings, 'VIEW_LOG_RETENTION_DAYS', 5)
+    with scopes_disabled():
+        ViewLog.objects.create(recipe=recipe_1_s1, created_by=auth.get_user(u1_s1), space=space_1)
+        ViewLog.objects.create(recipe=recipe_1_s1, created_by=auth.get_user(u1_s2), space=space_2)
+        ViewLog.objects.update(created_at=timezone.now() - timedelta(days=20))
+
+    call_command('cleanuphistory', '--space', str(space_2.id))
+    with scopes_disabled():
+        assert list(ViewLog.objects.values_list('space', flat=True)) == [space_1.id]
+
+
+def test_retention_lock(space_1, u1_s1, recipe_1_s1, monkeypatch):
+    monkeypatch.setattr(settings, 'VIEW_LOG_RETENTION_DAYS', 5)
+    with scopes_disabled():
+        ViewLog.objects.create(recipe=recipe_1_s1, created_by=auth.get_user(u1_s1), space=space_1)
+        ViewLog.objects.update(created_at=timezone.now() - timedelta(days=20))
+
+    # on postgres only one process deletes history at a time
+    other = connections.create_connection('default')
+    try:
+        if connection.vendor == 'postgresql':
+            with other.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_lock(%s)', [RETENTION_LOCK])
+            assert delete_old_history() is None
+            with scopes_disabled():
+                assert ViewLog.objects.count() == 1
+            with other.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_unlock(%s)', [RETENTION_LOCK])
+        assert delete_old_history()['view_log'] == 1
+    finally:
+        other.close()
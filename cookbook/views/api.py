@@ -1,8 +1,11 @@
-import io
+import base64
+import hashlib
 import json
 import re
+import time
 import uuid
 from collections import OrderedDict
+from datetime import datetime, timedelta
 
 import requests
 from annoying.decorators import ajax_request
@@ -10,44 +13,55 @@ from annoying.functions import get_object_or_None
 from django.contrib import messages
 from django.contrib.auth.models import User
 from django.contrib.postgres.search import TrigramSimilarity
+from django.core.cache import caches
 from django.core.exceptions import FieldError, ValidationError
 from django.core.files import File
-from django.db.models import (Case, Count, Exists, F, IntegerField, OuterRef, ProtectedError, Q,
-                              Subquery, Value, When)
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import (Case, Count, Exists, F, FloatField, IntegerField, OuterRef,
+                              Prefetch, ProtectedError, Q, Subquery, Sum, Value, When)
 from django.db.models.fields.related import ForeignObjectRel
-from django.db.models.functions import Coalesce
-from django.http import FileResponse, HttpResponse, JsonResponse
+from django.db.models.functions import Cast, Coalesce, NullIf
+from django.http import FileResponse, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, redirect
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.utils.translation import gettext as _
-from django_scopes import scopes_disabled
-from icalendar import Calendar, Event
+from django.views.decorators.http import condition
+from django_scopes import scope, scopes_disabled
+from icalendar import Event
 from recipe_scrapers import NoSchemaFoundInWildMode, WebsiteNotImplementedError, scrape_me
 from rest_framework import decorators, status, viewsets
-from rest_framework.exceptions import APIException, PermissionDenied
+from rest_framework.exceptions import APIException, NotFound, ParseError, PermissionDenied
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.parsers import MultiPartParser
 from rest_framework.renderers import JSONRenderer, TemplateHTMLRenderer
 from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 from rest_framework.viewsets import ViewSetMixin
 from treebeard.exceptions import InvalidMoveToDescendant, InvalidPosition, PathOverflow
 
-from cookbook.helper.HelperFunctions import str2bool
+from cookbook.helper.cache_helper import get_meal_plans_changed
+from cookbook.helper.HelperFunctions import random_sample, random_subquery, str2bool
 from cookbook.helper.image_processing import handle_image
 from cookbook.helper.ingredient_parser import IngredientParser
 from cookbook.helper.permission_helper import (CustomIsAdmin, CustomIsGuest, CustomIsOwner,
                                                CustomIsShare, CustomIsShared, CustomIsUser,
                                                group_required)
 from cookbook.helper.recipe_html_import import get_recipe_from_source
-from cookbook.helper.recipe_search import RecipeFacet, RecipeSearch, old_search
+from cookbook.helper.recipe_search import RecipeFacet, RecipeSearch, annotate_cooklog, old_search
 from cookbook.helper.recipe_url_import import get_from_scraper
-from cookbook.helper.shopping_helper import list_from_recipe, shopping_helper
+from cookbook.helper.shopping_helper import (bulk_update_entries, list_from_mealplans, list_from_recipe,
+                                             onhand_prefetch, onhand_status, shopping_aggregate,
+                                             shopping_helper)
+from cookbook.managers import set_similarity_threshold
 from cookbook.models import (Automation, BookmarkletImport, CookLog, Food, FoodInheritField,
                              ImportLog, Ingredient, Keyword, MealPlan, MealType, Recipe, RecipeBook,
                              RecipeBookEntry, ShareLink, ShoppingList, ShoppingListEntry,
-                             ShoppingListRecipe, Step, Storage, Supermarket, SupermarketCategory,
-                             SupermarketCategoryRelation, Sync, SyncLog, Unit, UserFile,
-                             UserPreference, ViewLog)
+                             ShoppingListEntryTombstone, ShoppingListRecipe, Step, Storage,
+                             Supermarket, SupermarketCategory, SupermarketCategoryRelation, Sync,
+                             SyncLog, Unit, UserFile, UserPreference, ViewLog)
 from cookbook.provider.dropbox import Dropbox
 from cookbook.provider.local import Local
 from cookbook.provider.nextcloud import Nextcloud
@@ -56,11 +70,14 @@ from cookbook.serializer import (AutomationSerializer, BookmarkletImportSerializ
                                  CookLogSerializer, FoodInheritFieldSerializer, FoodSerializer,
                                  FoodShoppingUpdateSerializer, ImportLogSerializer,
                                  IngredientSerializer, KeywordSerializer, MealPlanSerializer,
+                                 MealPlanShoppingSerializer,
                                  MealTypeSerializer, RecipeBookEntrySerializer,
                                  RecipeBookSerializer, RecipeImageSerializer,
                                  RecipeOverviewSerializer, RecipeSerializer,
                                  RecipeShoppingUpdateSerializer, RecipeSimpleSerializer,
-                                 ShoppingListAutoSyncSerializer, ShoppingListEntrySerializer,
+                                 ShoppingListAutoSyncSerializer,
+                                 ShoppingListEntryAggregateSerializer,
+                                 ShoppingListEntryBulkSerializer, ShoppingListEntrySerializer,
                                  ShoppingListRecipeSerializer, ShoppingListSerializer,
                                  StepSerializer, StorageSerializer,
                                  SupermarketCategoryRelationSerializer,
@@ -91,7 +108,7 @@ class StandardFilterMixin(ViewSetMixin):
         random = self.request.query_params.get('random', False)
         if limit is not None:
             if random:
-                queryset = queryset.order_by("?")[:int(limit)]
+                queryset = random_sample(queryset, int(limit))
             else:
                 queryset = queryset[:int(limit)]
         return queryset
@@ -121,10 +138,10 @@ class ExtendedRecipeMixin():
             queryset = queryset.annotate(recipe_count=Coalesce(Subquery(recipe_count), 0))
 
             # add a recipe image annotation to the query
-            image_subquery = Recipe.objects.filter(**{recipe_filter: OuterRef('id')}, space=space).exclude(image__isnull=True).exclude(image__exact='').order_by("?").values('image')[:1]
+            image_subquery = random_subquery(Recipe.objects.filter(**{recipe_filter: OuterRef('id')}, space=space).exclude(image__isnull=True).exclude(image__exact=''), 'image')
             if tree:
-                image_children_subquery = Recipe.objects.filter(**{f"{recipe_filter}__path__startswith": OuterRef('path')},
-                                                                space=space).exclude(image__isnull=True).exclude(image__exact='').order_by("?").values('image')[:1]
+                image_children_subquery = random_subquery(Recipe.objects.filter(**{f"{recipe_filter}__path__startswith": OuterRef('path')},
+                                                                                space=space).exclude(image__isnull=True).exclude(image__exact=''), 'image')
             else:
                 image_children_subquery = None
             if images:
@@ -137,6 +154,13 @@ class ExtendedRecipeMixin():
 class FuzzyFilterMixin(ViewSetMixin, ExtendedRecipeMixin):
     schema = FilterSchema()
 
+    def dispatch(self, request, *args, **kwargs):
+        # the similarity threshold of the fuzzy search only lasts for the transaction the list is loaded in
+        if request.method == 'GET':
+            with transaction.atomic():
+                return super().dispatch(request, *args, **kwargs)
+        return super().dispatch(request, *args, **kwargs)
+
     def get_queryset(self):
         self.queryset = self.queryset.filter(space=self.request.space).order_by('name')
         query = self.request.query_params.get('query', None)
@@ -144,8 +168,11 @@ class FuzzyFilterMixin(ViewSetMixin, ExtendedRecipeMixin):
 
         if query is not None and query not in ["''", '']:
             if fuzzy:
+                # both filters can use the trigram indexes, similarity is only calculated for the matches
+                set_similarity_threshold(self.request.user.searchpreference.trigram_threshold)
                 self.queryset = (
                     self.queryset
+                    .filter(Q(name__trigram_similar=query) | Q(name__istartswith=query))
                     .annotate(starts=Case(When(name__istartswith=query, then=(Value(.3, output_field=IntegerField()))), default=Value(0)))
                     .annotate(trigram=TrigramSimilarity('name', query))
                     .annotate(sort=F('starts')+F('trigram'))
@@ -173,8 +200,9 @@ class FuzzyFilterMixin(ViewSetMixin, ExtendedRecipeMixin):
         random = self.request.query_params.get('random', False)
         if limit is not None:
             if random:
-                self.queryset = self.queryset.order_by("?")
-            self.queryset = self.queryset[:int(limit)]
+                self.queryset = random_sample(self.queryset, int(limit))
+            else:
+                self.queryset = self.queryset[:int(limit)]
         return self.annotate_recipe(queryset=self.queryset, request=self.request, serializer=self.serializer_class)
 
 
@@ -450,12 +478,11 @@ class FoodViewSet(viewsets.ModelViewSet, TreeMixin):
     pagination_class = DefaultPagination
 
     def get_queryset(self):
-        self.request._shared_users = [x.id for x in list(self.request.user.get_shopping_share())] + [self.request.user.id]
-
         self.queryset = super().get_queryset()
         shopping_status = ShoppingListEntry.objects.filter(space=self.request.space, food=OuterRef('id'), checked=False).values('id')
-        # onhand_status = self.queryset.annotate(onhand_status=Exists(onhand_users_set__in=[shared_users]))
-        return self.queryset.annotate(shopping_status=Exists(shopping_status)).prefetch_related('onhand_users', 'inherit_fields').select_related('recipe', 'supermarket_category')
+        return self.queryset.annotate(
+            shopping_status=Exists(shopping_status), onhand_status=onhand_status(self.request.user)
+        ).prefetch_related('inherit_fields').select_related('recipe', 'supermarket_category')
 
     @ decorators.action(detail=True,  methods=['PUT'], serializer_class=FoodShoppingUpdateSerializer,)
     # TODO DRF only allows one action in a decorator action without overriding get_operation_id_base() this should be PUT and DELETE probably
@@ -463,8 +490,7 @@ class FoodViewSet(viewsets.ModelViewSet, TreeMixin):
         if self.request.space.demo:
             raise PermissionDenied(detail='Not available in demo', code=None)
         obj = self.get_object()
-        shared_users = list(self.request.user.get_shopping_share())
-        shared_users.append(request.user)
+        shared_users = [*self.request.user.get_shopping_share_ids(), request.user.id]
         if request.data.get('_delete', False) == 'true':
             ShoppingListEntry.objects.filter(food=obj, checked=False, space=request.space, created_by__in=shared_users).delete()
             content = {'msg': _(f'{obj.name} was removed from the shopping list.')}
@@ -491,7 +517,7 @@ class RecipeBookViewSet(viewsets.ModelViewSet, StandardFilterMixin):
     permission_classes = [CustomIsOwner]
 
     def get_queryset(self):
-        self.queryset = self.queryset.filter(Q(created_by=self.request.user) | Q(shared=self.request.user)).filter(
+        self.queryset = self.queryset.filter(RecipeBook.visible_filter(self.request.user)).filter(
             space=self.request.space).distinct()
         return super().get_queryset()
 
@@ -510,8 +536,7 @@ class RecipeBookEntryViewSet(viewsets.ModelViewSet, viewsets.GenericViewSet):
     permission_classes = [CustomIsOwner]
 
     def get_queryset(self):
-        queryset = self.queryset.filter(
-            Q(book__created_by=self.request.user) | Q(book__shared=self.request.user)).filter(
+        queryset = self.queryset.filter(RecipeBookEntry.visible_filter(self.request.user)).filter(
             book__space=self.request.space).distinct()
 
         recipe_id = self.request.query_params.get('recipe', None)
@@ -539,10 +564,17 @@ class MealPlanViewSet(viewsets.ModelViewSet):
     permission_classes = [CustomIsOwner]
 
     def get_queryset(self):
-        queryset = self.queryset.filter(
-            Q(created_by=self.request.user)
-            | Q(shared=self.request.user)
-        ).filter(space=self.request.space).distinct().all()
+        queryset = self.queryset.filter(MealPlan.visible_filter(self.request.user)).filter(space=self.request.space).distinct().all()
+        # everything the serializer shows is loaded for the whole calendar range at once
+        recipes = annotate_cooklog(Recipe.objects.filter(space=self.request.space), self.request.user).prefetch_related(
+            Prefetch('keywords', queryset=Keyword.objects.filter(space=self.request.space))
+        )
+        queryset = queryset.annotate(
+            in_shopping=Exists(ShoppingListRecipe.objects.filter(mealplan=OuterRef('pk')))
+        ).select_related('meal_type').prefetch_related(
+            Prefetch('recipe', queryset=recipes),
+            Prefetch('shared', queryset=User.objects.filter(userpreference__space=self.request.space).annotate(space_id=F('userpreference__space')))
+        )
 
         from_date = self.request.query_params.get('from_date', None)
         if from_date is not None:
@@ -553,6 +585,49 @@ class MealPlanViewSet(viewsets.ModelViewSet):
             queryset = queryset.filter(date__lte=to_date)
         return queryset
 
+    @decorators.action(detail=False, methods=['POST'], serializer_class=MealPlanShoppingSerializer)
+    def shopping(self, request):
+        if self.request.space.demo:
+            raise PermissionDenied(detail='Not available in demo', code=None)
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+
+        # meal plans shared with the user stay on the shopping list of their owner
+        mealplans = MealPlan.objects.filter(MealPlan.owner_filter(request.user), space=request.space, id__in=self.get_queryset().order_by().values('id'))
+        if ids := data.get('ids', None):
+            mealplans = mealplans.filter(id__in=ids)
+        if 'from_date' in data:
+            mealplans = mealplans.filter(date__gte=data['from_date'])
+        if 'to_date' in data:
+            mealplans = mealplans.filter(date__lte=data['to_date'])
+        list_recipes = list_from_mealplans(mealplans, request.space, created_by=request.user)
+        return Response({'list_recipes': [x.id for x in list_recipes]})
+
+    @decorators.action(detail=False, methods=['GET'])
+    def nutrition(self, request):
+        """
+        nutrition totals of the meal plans per day and meal type, accepts the same from_date and to_date
+        parameters as the list. Recipe nutrition is scaled by meal plan servings / recipe servings.
+        """
+        mealplans = MealPlan.objects.filter(
+            space=request.space, id__in=self.get_queryset().order_by().values('id'), recipe__nutrition__isnull=False
+        )
+        fields = ['calories', 'proteins', 'fats', 'carbohydrates']
+        # cast to float, sqlite would otherwise divide integer values
+        scale = Cast('servings', FloatField()) / NullIf(F('recipe__servings'), 0)
+        totals = {x: Sum(Cast(f'recipe__nutrition__{x}', FloatField()) * scale) for x in fields}
+        rows = mealplans.order_by().values('date', 'meal_type', 'meal_type__name').annotate(**totals).order_by('date', 'meal_type__order', 'meal_type')
+
+        days = OrderedDict()
+        for row in rows:
+            day = days.setdefault(row['date'], {'date': row['date'], **{x: 0 for x in fields}, 'meal_types': []})
+            for x in fields:
+                row[x] = round(float(row[x] or 0), 2)
+                day[x] = round(day[x] + row[x], 2)
+            day['meal_types'].append({'id': row['meal_type'], 'name': row['meal_type__name'], **{x: row[x] for x in fields}})
+        return Response(list(days.values()))
+
 
 class MealTypeViewSet(viewsets.ModelViewSet):
     """
@@ -603,14 +678,126 @@ class RecipePagination(PageNumberPagination):
     page_size = 25
     page_size_query_param = 'page_size'
     max_page_size = 100
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+    result_cache_timeout = 3600
 
     def paginate_queryset(self, queryset, request, view=None):
         if queryset is None:
             raise Exception
+        self.keyset = self.cursor_query_param in request.query_params and self.get_keyset_ordering(queryset) is not None
+        if self.keyset:
+            return self.paginate_keyset(queryset, request)
+        if settings.RECIPE_RESULT_CACHE and (search := getattr(view, 'search', None)) and (cache_key := search.get_cache_key()):
+            return self.paginate_result_cache(queryset, request, view, cache_key)
         self.facets = RecipeFacet(request, queryset=queryset)
         return super().paginate_queryset(queryset, request, view)
 
+    def paginate_result_cache(self, queryset, request, view, cache_key):
+        """
+        the ordered ids of the search result are cached until recipe data of the space changes, every page is a slice
+        of those ids so filtering, ranking and counting only run once for all pages of a search
+        """
+        if cached := caches['default'].get(cache_key, None):
+            recipe_ids, facets_key = cached
+            self.facets = RecipeFacet(request, queryset=queryset, hash_key=facets_key)
+        else:
+            recipe_ids = list(dict.fromkeys(queryset.values_list('id', flat=True)))
+            self.facets = RecipeFacet(request, queryset=queryset)
+            caches['default'].set(cache_key, (recipe_ids, self.facets.hash_key), self.result_cache_timeout)
+        page_ids = super().paginate_queryset(recipe_ids, request, view)
+        # the page is loaded from the search queryset so annotations used by the serializer are present
+        recipes = queryset.in_bulk(page_ids)
+        return [recipes[x] for x in page_ids if x in recipes]
+
+    def paginate_keyset(self, queryset, request):
+        """
+        the cursor holds the sort values of the last recipe of the previous page, the next page is selected with a
+        filter on those values instead of an OFFSET so every page costs the same. id is the tiebreaker of the order.
+        the first page (empty cursor) also returns the facets, the count is only calculated when requested
+        """
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.ordering = self.get_keyset_ordering(queryset)
+        # scores can be float4 on postgres, they are compared as double precision like the float of the cursor
+        queryset = queryset.annotate(**{f'{f}_key': Cast(f, FloatField()) for f, desc in self.ordering if self.is_score(queryset, f)})
+        self.ordering = [(f'{f}_key' if self.is_score(queryset, f) else f, desc) for f, desc in self.ordering]
+        queryset = queryset.order_by(*[F(f).desc(nulls_last=True) if desc else F(f).asc(nulls_last=True) for f, desc in self.ordering])
+
+        self.count = queryset.count() if str2bool(request.query_params.get(self.count_query_param, False)) else None
+        self.facets = None
+        if cursor := request.query_params.get(self.cursor_query_param):
+            queryset = queryset.filter(self.keyset_filter(self.decode_cursor(cursor)))
+        else:
+            self.facets = RecipeFacet(request, queryset=queryset)
+
+        results = list(queryset[:self.page_size + 1])
+        self.next_cursor = None
+        if len(results) > self.page_size:
+            results = results[:self.page_size]
+            self.next_cursor = self.encode_cursor([getattr(results[-1], f) for f, desc in self.ordering])
+        return results
+
+    @staticmethod
+    def get_keyset_ordering(queryset):
+        """
+        the sort fields of queryset with id as the tiebreaker, None if the order cannot be paged by values
+        (random order or expressions), such results are paged by offset
+        """
+        ordering = []
+        for o in queryset.query.order_by:
+            if not isinstance(o, str) or o == '?':
+                return None
+            field = 'id' if o.lstrip('-') == 'pk' else o.lstrip('-')
+            ordering.append((field, o.startswith('-')))
+            if field == 'id':
+                return ordering
+        return ordering + [('id', False)]
+
+    @staticmethod
+    def is_score(queryset, field):
+        annotation = queryset.query.annotations.get(field, None)
+        return annotation is not None and isinstance(annotation.output_field, FloatField)
+
+    def keyset_filter(self, values):
+        # rows after the cursor: equal on all previous sort fields and after the cursor on the current one, NULLs sort last
+        keyset = Q(pk__in=[])
+        equal = Q()
+        for (field, desc), value in zip(self.ordering, values):
+            if value is not None:
+                keyset |= equal & (Q(**{f'{field}__lt' if desc else f'{field}__gt': value}) | Q(**{f'{field}__isnull': True}))
+                equal &= Q(**{field: value})
+            else:
+                equal &= Q(**{f'{field}__isnull': True})
+        return keyset
+
+    def encode_cursor(self, values):
+        return base64.urlsafe_b64encode(json.dumps(values, cls=DjangoJSONEncoder).encode()).decode()
+
+    def decode_cursor(self, cursor):
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except (TypeError, ValueError):
+            raise NotFound(_('Invalid cursor'))
+        if not isinstance(values, list) or len(values) != len(self.ordering):
+            raise NotFound(_('Invalid cursor'))
+        return values
+
+    def get_next_cursor_link(self):
+        if not self.next_cursor:
+            return None
+        url = remove_query_param(self.request.build_absolute_uri(), self.count_query_param)
+        return replace_query_param(url, self.cursor_query_param, self.next_cursor)
+
     def get_paginated_response(self, data):
+        if self.keyset:
+            return Response(OrderedDict([
+                ('count', self.count),
+                ('next', self.get_next_cursor_link()),
+                ('previous', None),
+                ('results', data),
+                ('facets', self.facets.get_facets(from_cache=True) if self.facets else None)
+            ]))
         return Response(OrderedDict([
             ('count', self.page.paginator.count),
             ('next', self.get_next_link()),
@@ -640,13 +827,19 @@ class RecipeViewSet(viewsets.ModelViewSet):
         QueryParam(name='internal', description=_('If only internal recipes should be returned. [''true''/''<b>false</b>'']')),
         QueryParam(name='random', description=_('Returns the results in randomized order. [''true''/''<b>false</b>'']')),
         QueryParam(name='new', description=_('Returns new results first in search results. [''true''/''<b>false</b>'']')),
+        QueryParam(name='cursor', description=_('Enables cursor pagination, empty for the first page then the cursor of the <b>next</b> link.')),
+        QueryParam(name='count', description=_('Include the total number of results when using a cursor. [''true''/''<b>false</b>'']')),
     ]
     schema = QueryParamAutoSchema()
 
     def get_queryset(self):
 
         if self.detail:
-            self.queryset = self.queryset.filter(space=self.request.space)
+            # ingredients are needed for every step and its instruction rendering
+            self.queryset = self.queryset.filter(space=self.request.space).prefetch_related(
+                Prefetch('steps__ingredients', queryset=Ingredient.objects.filter(space=self.request.space).select_related('food', 'unit')
+                         .prefetch_related(onhand_prefetch(self.request.user), 'food__inherit_fields'))
+            )
             return super().get_queryset()
 
         share = self.request.query_params.get('share', None)
@@ -655,8 +848,11 @@ class RecipeViewSet(viewsets.ModelViewSet):
 
         # self.queryset = search_recipes(self.request, self.queryset, self.request.GET)
         params = {x: self.request.GET.get(x) if len({**self.request.GET}[x]) == 1 else self.request.GET.getlist(x) for x in list(self.request.GET)}
-        search = RecipeSearch(self.request, **params)
-        self.queryset = search.get_queryset(self.queryset).prefetch_related('cooklog_set')
+        self.search = RecipeSearch(self.request, **params)
+        # rating and last cooked are annotated by the search, keywords are loaded for the whole page at once
+        self.queryset = self.search.get_queryset(self.queryset).prefetch_related(
+            Prefetch('keywords', queryset=Keyword.objects.filter(space=self.request.space))
+        )
         return self.queryset
 
     def list(self, request, *args, **kwargs):
@@ -665,7 +861,9 @@ class RecipeViewSet(viewsets.ModelViewSet):
                 'new': str(self.get_queryset().query),
                 'old': str(old_search(request).query)
             })
-        return super().list(request, *args, **kwargs)
+        # the similarity threshold of the trigram search only lasts for the transaction the results are loaded in
+        with transaction.atomic():
+            return super().list(request, *args, **kwargs)
 
     # TODO write extensive tests for permissions
 
@@ -752,12 +950,7 @@ class ShoppingListRecipeViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         self.queryset = self.queryset.filter(Q(shoppinglist__space=self.request.space) | Q(entries__space=self.request.space))
-        return self.queryset.filter(
-            Q(shoppinglist__created_by=self.request.user)
-            | Q(shoppinglist__shared=self.request.user)
-            | Q(entries__created_by=self.request.user)
-            | Q(entries__created_by__in=list(self.request.user.get_shopping_share()))
-        ).distinct().all()
+        return self.queryset.filter(ShoppingListRecipe.visible_filter(self.request.user)).distinct().all()
 
 
 class ShoppingListEntryViewSet(viewsets.ModelViewSet):
@@ -771,26 +964,89 @@ class ShoppingListEntryViewSet(viewsets.ModelViewSet):
             description=_('Filter shopping list entries on checked.  [''true'', ''false'', ''both'', ''<b>recent</b>'']<br>  - ''recent'' includes unchecked items and recently completed items.')
         ),
         QueryParam(name='supermarket', description=_('Returns the shopping list entries sorted by supermarket category order.'), qtype='int'),
+        QueryParam(
+            name='since',
+            description=_('Returns only entries changed after the token of a previous response and the ids of deleted entries.  Empty to get all entries and a first token.')
+        ),
+        QueryParam(
+            name='aggregate',
+            description=_('Merges entries with the same food, unit and checked state into one row with the summed amount. [''true''/''<b>false</b>'']')
+        ),
+        QueryParam(
+            name='delayed',
+            description=_('Includes delayed entries when aggregating, they are merged separately. [''true''/''<b>false</b>'']')
+        ),
     ]
     schema = QueryParamAutoSchema()
+    # entries saved in a transaction that commits after a token was issued can have an older timestamp, they are sent again
+    sync_overlap = timedelta(seconds=10)
 
     def get_queryset(self):
         self.queryset = self.queryset.filter(space=self.request.space)
 
-        self.queryset = self.queryset.filter(
-            Q(created_by=self.request.user)
-            | Q(shoppinglist__shared=self.request.user)
-            | Q(created_by__in=list(self.request.user.get_shopping_share()))
-        ).distinct().all()
+        self.queryset = self.queryset.filter(ShoppingListEntry.visible_filter(self.request.user)).distinct().all()
 
         if pk := self.request.query_params.getlist('id', []):
             self.queryset = self.queryset.filter(food__id__in=[int(i) for i in pk])
 
+        if 'since' in self.request.query_params:
+            # every change is synced, also changes that move an entry out of the checked filter
+            return self.queryset.select_related(
+                'unit', 'food', 'ingredient', 'created_by', 'list_recipe', 'list_recipe__mealplan', 'list_recipe__recipe'
+            ).prefetch_related(onhand_prefetch(self.request.user), 'food__inherit_fields')
+
         if 'checked' in self.request.query_params or 'recent' in self.request.query_params:
             return shopping_helper(self.queryset, self.request)
 
         # TODO once old shopping list is removed this needs updated to sharing users in preferences
-        return self.queryset
+        return self.queryset.prefetch_related(onhand_prefetch(self.request.user), 'food__inherit_fields')
+
+    def list(self, request, *args, **kwargs):
+        if str2bool(request.query_params.get('aggregate', False)):
+            # entries are merged by the database, the visibility joins of get_queryset must not multiply the amounts
+            entries = ShoppingListEntry.objects.filter(space=request.space, id__in=self.get_queryset().order_by().values('id'))
+            rows = shopping_aggregate(shopping_helper(entries, request), delayed=str2bool(request.query_params.get('delayed', False)))
+            return Response(ShoppingListEntryAggregateSerializer(rows, many=True).data)
+
+        if (since := request.query_params.get('since', None)) is None:
+            return super().list(request, *args, **kwargs)
+
+        token = timezone.now()
+        entries = self.get_queryset()
+        deleted = []
+        if since:
+            try:
+                since = parse_datetime(since)
+            except ValueError:
+                since = None
+            if since is None:
+                raise ParseError(_('Invalid token'))
+            if settings.SHOPPING_SYNC_RETENTION_DAYS and since < timezone.now() - timedelta(days=settings.SHOPPING_SYNC_RETENTION_DAYS):
+                # deleted entries may already be forgotten, the client has to reload the list
+                raise ParseError(_('Token expired'))
+            since = since - self.sync_overlap
+            entries = entries.filter(updated_at__gte=since)
+            deleted = ShoppingListEntryTombstone.objects.filter(
+                space=request.space, deleted_at__gte=since, created_by__in=[request.user.id, *request.user.get_shopping_share_ids()]
+            ).values_list('entry_id', flat=True).distinct()
+        return Response({
+            'token': token,
+            'results': self.get_serializer(entries, many=True).data,
+            'deleted': list(deleted),
+        })
+
+    @decorators.action(detail=False, methods=['POST'], serializer_class=ShoppingListEntryBulkSerializer)
+    def bulk(self, request):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+
+        entries = ShoppingListEntry.objects.filter(space=request.space, id__in=self.get_queryset().order_by().values('id'))
+        if ids := data.get('ids', None):
+            entries = entries.filter(id__in=ids)
+        if (food := data.get('food', None)) is not None:
+            entries = entries.filter(food_id=food)
+        return Response({'entries': bulk_update_entries(entries, request.user, data)})
 
 
 # TODO deprecate
@@ -800,11 +1056,7 @@ class ShoppingListViewSet(viewsets.ModelViewSet):
     permission_classes = [CustomIsOwner | CustomIsShared]
 
     def get_queryset(self):
-        return self.queryset.filter(
-            Q(created_by=self.request.user)
-            | Q(shared=self.request.user)
-            | Q(created_by__in=list(self.request.user.get_shopping_share()))
-        ).filter(space=self.request.space).distinct()
+        return self.queryset.filter(ShoppingList.visible_filter(self.request.user)).filter(space=self.request.space).distinct()
 
     def get_serializer_class(self):
         try:
@@ -981,11 +1233,26 @@ def log_cooking(request, recipe_id):
     return {'error': 'recipe does not exist'}
 
 
+def plan_ical_etag(request, from_date, to_date):
+    changed = get_meal_plans_changed(request.user.userpreference.space_id)
+    return hashlib.md5(f'{request.user.id}_{from_date}_{to_date}_{changed}'.encode()).hexdigest()
+
+
+def plan_ical_last_modified(request, from_date, to_date):
+    return datetime.fromtimestamp(get_meal_plans_changed(request.user.userpreference.space_id), tz=timezone.utc)
+
+
 @group_required('user')
+@condition(etag_func=plan_ical_etag, last_modified_func=plan_ical_last_modified)
 def get_plan_ical(request, from_date, to_date):
+    """
+    iCal feed of the meal plans of the user, calendar clients poll it so an unchanged feed is answered with
+    304 Not Modified from the ETag and Last-Modified without reading the meal plans
+    """
+    space = request.user.userpreference.space
     queryset = MealPlan.objects.filter(
         Q(created_by=request.user) | Q(shared=request.user)
-    ).filter(space=request.user.userpreference.space).distinct().all()
+    ).filter(space=space).distinct().select_related('meal_type', 'recipe')
 
     if from_date is not None:
         queryset = queryset.filter(date__gte=from_date)
@@ -993,20 +1260,85 @@ def get_plan_ical(request, from_date, to_date):
     if to_date is not None:
         queryset = queryset.filter(date__lte=to_date)
 
-    cal = Calendar()
+    def stream():
+        # runs after the request left the scope middleware
+        with scope(space=space):
+            yield b'BEGIN:VCALENDAR\r\n'
+            for p in queryset.iterator():
+                event = Event()
+                event['uid'] = p.id
+                event.add('dtstart', p.date)
+                event.add('dtend', p.date)
+                event['summary'] = f'{p.meal_type.name}: {p.get_label()}'
+                event['description'] = p.note
+                yield event.to_ical()
+            yield b'END:VCALENDAR\r\n'
+
+    response = StreamingHttpResponse(stream(), content_type='text/calendar')
+    response["Content-Disposition"] = f'attachment; filename=meal_plan_{from_date}-{to_date}.ics'  # noqa: E501
 
-    for p in queryset:
-        event = Event()
-        event['uid'] = p.id
-        event.add('dtstart', p.date)
-        event.add('dtend', p.date)
-        event['summary'] = f'{p.meal_type.name}: {p.get_label()}'
-        event['description'] = p.note
-        cal.add_component(event)
+    return response
 
-    response = FileResponse(io.BytesIO(cal.to_ical()))
-    response["Content-Disposition"] = f'attachment; filename=meal_plan_{from_date}-{to_date}.ics'  # noqa: E501
 
+@group_required('user')
+def shopping_events(request):
+    """
+    Server sent event stream of changes to the shopping list entries of the user and the users sharing with them.
+    Changes are read from the update time of the entries and the tombstones of deleted entries, so changes made through
+    any worker are published. Events are add, check, update (also unchecking) and delete, the data holds the checked
+    state. The stream ends after SHOPPING_EVENT_STREAM_TIMEOUT seconds and the browser reconnects with the id of the
+    last event, the time the changes were read at. Every open stream occupies a worker thread, so the stream is only
+    available when ENABLE_SHOPPING_EVENTS is set.
+    """
+    if not settings.ENABLE_SHOPPING_EVENTS:
+        return JsonResponse({'error': 'shopping_events_disabled'}, status=404)
+    space = request.space
+    users = [request.user.id, *request.user.get_shopping_share_ids()]
+    overlap = ShoppingListEntryViewSet.sync_overlap
+    since = timezone.now()
+    try:
+        since = parse_datetime(request.headers.get('Last-Event-ID', None) or request.GET.get('last_event', '')) or since
+    except ValueError:
+        pass
+
+    def stream(since):
+        yield f'retry: {int(settings.SHOPPING_EVENT_POLL_INTERVAL * 1000)}\n\n'
+        deadline = time.monotonic() + settings.SHOPPING_EVENT_STREAM_TIMEOUT
+        seen = set()
+        # the response is streamed after the view returned and left the scope of the request
+        with scope(space=space):
+            while True:
+                token = timezone.now()
+                # changes of transactions that commit late can have an older timestamp, the overlap is read again
+                start = since - overlap
+                events = []
+                for e in ShoppingListEntry.objects.filter(space=space, created_by__in=users, updated_at__gte=start).only(
+                        'id', 'checked', 'created_at', 'completed_at', 'updated_at'):
+                    if e.created_at >= start:
+                        action = 'add'
+                    elif e.checked and e.completed_at and e.completed_at >= start:
+                        action = 'check'
+                    else:
+                        action = 'update'
+                    events.append((e.updated_at, ('entry', e.id, e.updated_at), {'id': e.id, 'action': action, 'checked': e.checked}))
+                for t in ShoppingListEntryTombstone.objects.filter(space=space, created_by__in=users, deleted_at__gte=start):
+                    events.append((t.deleted_at, ('tombstone', t.id), {'id': t.entry_id, 'action': 'delete'}))
+
+                for changed_at, key, data in sorted(events, key=lambda x: x[0]):
+                    if key not in seen:
+                        yield f'id: {token.isoformat()}\nevent: {data["action"]}\ndata: {json.dumps(data)}\n\n'
+                # changes read again in the next overlap are only sent once
+                seen = {key for changed_at, key, data in events}
+                since = token
+                if time.monotonic() >= deadline:
+                    return
+                # comment lines keep proxies from closing the connection and detect disconnected clients
+                yield ':\n\n'
+                time.sleep(settings.SHOPPING_EVENT_POLL_INTERVAL)
+
+    response = StreamingHttpResponse(stream(since), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
     return response
 
 
@@ -1139,14 +1471,17 @@ def get_facets(request):
     key = request.GET.get('hash', None)
     food = request.GET.get('food', None)
     keyword = request.GET.get('keyword', None)
-    facets = RecipeFacet(request, hash_key=key)
-
-    if food:
-        results = facets.add_food_children(food)
-    elif keyword:
-        results = facets.add_keyword_children(keyword)
-    else:
-        results = facets.get_facets()
+    with transaction.atomic():
+        # the cached search can filter with the trigram operator
+        set_similarity_threshold(request.user.searchpreference.trigram_threshold)
+        facets = RecipeFacet(request, hash_key=key)
+
+        if food:
+            results = facets.add_food_children(food)
+        elif keyword:
+            results = facets.add_keyword_children(keyword)
+        else:
+            results = facets.get_facets()
 
     return JsonResponse(
         {
@@ -26,6 +26,7 @@ from cookbook.forms import (CommentForm, Recipe, SearchPreferenceForm, ShoppingP
                             SpaceCreateForm, SpaceJoinForm, SpacePreferenceForm, User,
                             UserCreateForm, UserNameForm, UserPreference, UserPreferenceForm)
 from cookbook.helper.permission_helper import group_required, has_group_permission, share_link_valid
+from cookbook.managers import sqlite_fts_available
 from cookbook.models import (Comment, CookLog, Food, FoodInheritField, InviteLink, Keyword,
                              MealPlan, RecipeImport, SearchFields, SearchPreference, ShareLink,
                              ShoppingList, Space, Unit, UserFile, ViewLog)
@@ -417,7 +418,9 @@ def user_settings(request):
         search_form.fields['search'].disabled = True
         search_form.fields['lookup'].disabled = True
         search_form.fields['trigram'].disabled = True
-        search_form.fields['fulltext'].disabled = True
+        # sqlite searches the fulltext fields with fts5 if it is compiled in
+        if not sqlite_fts_available():
+            search_form.fields['fulltext'].disabled = True
 
     return render(request, 'settings.html', {
         'preference_form': preference_form,
@@ -49,6 +49,24 @@ STICKY_NAV_PREF_DEFAULT = bool(int(os.getenv('STICKY_NAV_PREF_DEFAULT', True)))
 
 # minimum interval that users can set for automatic sync of shopping lists
 SHOPPING_MIN_AUTOSYNC_INTERVAL = int(os.getenv('SHOPPING_MIN_AUTOSYNC_INTERVAL', 5))
+# server sent event stream of shopping list changes, every open stream occupies a worker thread
+ENABLE_SHOPPING_EVENTS = bool(int(os.getenv('ENABLE_SHOPPING_EVENTS', False)))
+# seconds a shopping list event stream stays open before the client reconnects
+SHOPPING_EVENT_STREAM_TIMEOUT = int(os.getenv('SHOPPING_EVENT_STREAM_TIMEOUT', 30))
+# seconds between checks for new events of an open stream, every check runs two queries so it defaults to the autosync interval
+SHOPPING_EVENT_POLL_INTERVAL = float(os.getenv('SHOPPING_EVENT_POLL_INTERVAL', SHOPPING_MIN_AUTOSYNC_INTERVAL))
+# days old history is kept before it is deleted by the cleanuphistory command, 0 keeps it forever. spaces can override them
+SHOPPING_RETENTION_DAYS = int(os.getenv('SHOPPING_RETENTION_DAYS', 0))
+VIEW_LOG_RETENTION_DAYS = int(os.getenv('VIEW_LOG_RETENTION_DAYS', 0))
+COOK_LOG_RETENTION_DAYS = int(os.getenv('COOK_LOG_RETENTION_DAYS', 0))
+SYNC_LOG_RETENTION_DAYS = int(os.getenv('SYNC_LOG_RETENTION_DAYS', 0))
+IMPORT_LOG_RETENTION_DAYS = int(os.getenv('IMPORT_LOG_RETENTION_DAYS', 0))
+# days deleted entries are kept for clients that sync their shopping list, 0 keeps them forever
+SHOPPING_SYNC_RETENTION_DAYS = int(os.getenv('SHOPPING_SYNC_RETENTION_DAYS', 30))
+# rows deleted per transaction by the cleanup
+RETENTION_BATCH_SIZE = int(os.getenv('RETENTION_BATCH_SIZE', 1000))
+# hours between cleanups of 'cleanuphistory --schedule' started by boot.sh, 0 disables them
+RETENTION_INTERVAL = float(os.getenv('RETENTION_INTERVAL', 0))
 
 ALLOWED_HOSTS = os.getenv('ALLOWED_HOSTS').split(',') if os.getenv('ALLOWED_HOSTS') else ['*']
 
@@ -323,12 +341,49 @@ else:
 #     }
 # }
 
-CACHES = {
-    'default': {
-        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
-        'LOCATION': 'default',
-    }
+# cache shared by all workers, locmem keeps a separate cache in every process
+# file, db or memcached share it and keep a small in process cache (L1) in front of it
+SHARED_CACHE_BACKENDS = {
+    'file': ('django.core.cache.backends.filebased.FileBasedCache', os.path.join(BASE_DIR, 'cache')),
+    'db': ('django.core.cache.backends.db.DatabaseCache', 'cookbook_cache'),
+    'memcached': ('django.core.cache.backends.memcached.PyMemcacheCache', '127.0.0.1:11211'),
 }
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'locmem')
+
+if CACHE_BACKEND in SHARED_CACHE_BACKENDS:
+    CACHES = {
+        'default': {
+            'BACKEND': 'cookbook.helper.cache_helper.TieredCache',
+            'LOCATION': 'default',
+            'OPTIONS': {
+                'SHARED': 'shared',
+                'L1_TIMEOUT': int(os.getenv('CACHE_L1_TIMEOUT', 5)),
+                'L1_MAX_ENTRIES': int(os.getenv('CACHE_L1_MAX_ENTRIES', 300)),
+            }
+        },
+        'shared': {
+            'BACKEND': SHARED_CACHE_BACKENDS[CACHE_BACKEND][0],
+            'LOCATION': os.getenv('CACHE_LOCATION', SHARED_CACHE_BACKENDS[CACHE_BACKEND][1]),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'default',
+        }
+    }
+
+# values that are replaced when their data changes are kept at most this long, with locmem a change made through
+# another worker is only seen once they expire
+CACHE_INVALIDATION_TIMEOUT = int(os.getenv('CACHE_INVALIDATION_TIMEOUT', 3600 if CACHE_BACKEND in SHARED_CACHE_BACKENDS else 300))
+
+# seconds the users that shared their shopping list with a user are cached, 0 only keeps them for the request.
+# with locmem other workers do not see the invalidation, so it is only enabled by default with a shared cache
+SHOPPING_SHARE_CACHE_TIMEOUT = int(os.getenv('SHOPPING_SHARE_CACHE_TIMEOUT', 60 if CACHE_BACKEND in SHARED_CACHE_BACKENDS else 0))
+
+# search results are cached until recipe data of the space changes, a change is only seen by all workers through a shared cache
+RECIPE_RESULT_CACHE = bool(int(os.getenv('RECIPE_RESULT_CACHE', CACHE_BACKEND in SHARED_CACHE_BACKENDS)))
 
 # Vue webpack settings
 VUE_DIR = os.path.join(BASE_DIR, 'vue')